@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 # python3.6 + ansible==2.7.12
 
+import os
+import re
+import math
 import json
+import shlex
+import time
+import queue
 import shutil
+import tempfile
 import unittest
 import logging
-from collections import namedtuple
+import threading
+import contextlib
+import multiprocessing
+import paramiko
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 from ansible.parsing.dataloader import DataLoader
 from ansible.vars.manager import VariableManager
+from ansible.vars.fact_cache import FactCache as AnsibleFactCache
 from ansible.inventory.manager import InventoryManager
 from ansible.playbook.play import Play
 from ansible.executor.playbook_executor import PlaybookExecutor
@@ -16,6 +29,8 @@ from ansible.plugins.callback import CallbackBase
 import ansible.constants as C
 from ansible.utils.display import Display
 
+from pyssh import SshTty
+
 
 # 创建logger, 存储playbook的输出日志
 logger = logging.getLogger()
@@ -26,6 +41,18 @@ logger.addHandler(fh)
 
 
 
+def result_message(event, result):
+    """
+    从ansible的结果中取出主要信息
+    """
+    data = result._result
+    if event == "ok":
+        return data["stdout"] if "stdout" in data else json.dumps(data, default=str)
+    if event == "failed":
+        return data.get("stderr") or data.get("msg", "")
+    return data.get("msg", "")
+
+
 class ResultCallback(CallbackBase):
     """
     ansible执行回调类
@@ -38,34 +65,564 @@ class ResultCallback(CallbackBase):
 
     def v2_runner_on_ok(self, result, **kwargs):
         """成功"""
-        self.host_ok[result._host.name] = result._result["stdout"]
+        self.host_ok[result._host.name] = result_message("ok", result)
 
     def v2_runner_on_unreachable(self, result, **kwargs):
         """不可达"""
-        self.host_unreachable[result._host.get_name()] = result
-        # self.host_unreachable[result._host.name] = result._result["msg"]
+        self.host_unreachable[result._host.get_name()] = result_message("unreachable", result)
 
     def v2_runner_on_failed(self, result, ignore_errors=False, **kwargs):
         """失败"""
-        self.host_failed[result._host.name] = result._result["stderr"]
+        self.host_failed[result._host.name] = result_message("failed", result)
+
+
+class StreamCallback(CallbackBase):
+    """
+    流式回调类，每台主机的结果放入有界队列，消费者处理不过来时ansible等待
+    """
+    def __init__(self, queue_size=1000, *args, **kwargs):
+        super(StreamCallback, self).__init__(*args, **kwargs)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = False
+
+    def put(self, event):
+        """
+        放入队列，消费者已退出时丢弃
+        """
+        while not self.stopped:
+            try:
+                self.queue.put(event, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def put_result(self, event, result):
+        """
+        整理为事件字典
+        """
+        self.put({
+            "event": event,
+            "host": result._host.get_name(),
+            "task": result._task.get_name(),
+            "changed": bool(result._result.get("changed", False)),
+            "result": result_message(event, result),
+        })
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        """成功"""
+        self.put_result("ok", result)
+
+    def v2_runner_on_unreachable(self, result, **kwargs):
+        """不可达"""
+        self.put_result("unreachable", result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False, **kwargs):
+        """失败"""
+        self.put_result("failed", result)
+
+    def v2_runner_on_skipped(self, result, **kwargs):
+        """跳过"""
+        self.put_result("skipped", result)
+
+
+class ProfileCallback(CallbackBase):
+    """
+    耗时统计回调类，记录每个任务和每台主机的开始、结束时间
+    """
+    def __init__(self, *args, **kwargs):
+        super(ProfileCallback, self).__init__(*args, **kwargs)
+        self.tasks = OrderedDict()  # task uuid -> {"name", "start", "end", "hosts": {主机: 耗时}}
+        self.host_start = {}
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        now = time.time()
+        self.tasks[task._uuid] = {"name": task.get_name(), "start": now, "end": now, "hosts": {}}
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.v2_playbook_on_task_start(task, False)
+
+    def v2_runner_on_start(self, host, task):
+        """ansible 2.8以上才有，没有时主机的开始时间取任务的开始时间"""
+        self.host_start[(host.get_name(), task._uuid)] = time.time()
+
+    def record(self, result):
+        now = time.time()
+        task = self.tasks.get(result._task._uuid)
+        if task is None:
+            return
+        host = result._host.get_name()
+        start = self.host_start.pop((host, result._task._uuid), task["start"])
+        task["hosts"][host] = now - start
+        task["end"] = max(task["end"], now)
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        self.record(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False, **kwargs):
+        self.record(result)
+
+    def v2_runner_on_unreachable(self, result, **kwargs):
+        self.record(result)
+
+    def v2_runner_on_skipped(self, result, **kwargs):
+        self.record(result)
+
+    def report(self, top=10):
+        """
+        生成报告：最慢的任务、最慢的主机、关键路径
+        关键路径为每个任务中最慢的主机，线性策略下任务要等最慢的主机结束才进入下一个任务
+        """
+        tasks = list(self.tasks.values())
+        host_total = {}
+        critical_path = []
+        for task in tasks:
+            for host, duration in task["hosts"].items():
+                host_total[host] = host_total.get(host, 0) + duration
+            if task["hosts"]:
+                host = max(task["hosts"], key=task["hosts"].get)
+                critical_path.append({"task": task["name"], "host": host, "duration": task["hosts"][host]})
+
+        slowest_tasks = sorted(
+            ({"task": task["name"], "duration": task["end"] - task["start"], "hosts": len(task["hosts"])}
+             for task in tasks),
+            key=lambda item: item["duration"], reverse=True)[:top]
+        slowest_hosts = sorted(
+            ({"host": host, "duration": duration} for host, duration in host_total.items()),
+            key=lambda item: item["duration"], reverse=True)[:top]
+
+        report = {
+            "total": tasks[-1]["end"] - tasks[0]["start"] if tasks else 0,
+            "slowest_tasks": slowest_tasks,
+            "slowest_hosts": slowest_hosts,
+            "critical_path": critical_path,
+        }
+        report["summary"] = self.summary(report)
+        return report
+
+    @staticmethod
+    def summary(report):
+        """
+        文本格式的报告
+        """
+        lines = ["total: %.2fs" % report["total"], "slowest tasks:"]
+        for item in report["slowest_tasks"]:
+            lines.append("  %8.2fs  %s (%s hosts)" % (item["duration"], item["task"], item["hosts"]))
+        lines.append("slowest hosts:")
+        for item in report["slowest_hosts"]:
+            lines.append("  %8.2fs  %s" % (item["duration"], item["host"]))
+        lines.append("critical path:")
+        for item in report["critical_path"]:
+            lines.append("  %8.2fs  %s @ %s" % (item["duration"], item["task"], item["host"]))
+        return "\n".join(lines)
+
+
+class FactCache(object):
+    """
+    本地fact缓存，每台主机一个json文件，文件修改时间超过ttl视为过期
+    """
+    def __init__(self, cache_dir="~/.ansible_facts", ttl=86400):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+        if os.path.exists(self.cache_dir) is False:
+            os.makedirs(self.cache_dir)
+
+    def path(self, host):
+        return os.path.join(self.cache_dir, "%s.json" % host.replace("/", "_"))
+
+    def get(self, host):
+        """
+        获取未过期的fact，没有或已过期返回None
+        """
+        path = self.path(host)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                return None
+            with open(path) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, host, facts):
+        path = self.path(host)
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump(facts, fp, default=str)
+        os.rename(tmp_path, path)
+
+    def load(self, inventory_obj, variable_manager):
+        """
+        把未过期的fact放入variable_manager，过期的清除，配合smart模式只对这些主机重新收集
+        """
+        for host in inventory_obj.get_hosts("all"):
+            facts = self.get(host.name)
+            if facts is None:
+                variable_manager.clear_facts(host.name)
+            else:
+                # smart模式根据module_setup判断是否已经收集过
+                facts["module_setup"] = True
+                variable_manager.set_host_facts(host, facts)
+
+
+class GatheringMode(object):
+    """
+    C.DEFAULT_GATHERING是进程全局的，执行期间由PlayIterator读取，没有play级别的设置；
+    不同取值的playbook互相等待，相同取值的可以并发，最后一个结束时恢复原值
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.mode = None
+        self.count = 0
+        self.default = None
+
+    @contextlib.contextmanager
+    def use(self, mode=None):
+        """
+        :param mode: smart/implicit/explicit，为None时使用ansible.cfg中的设置
+        """
+        with self.condition:
+            if self.count == 0:
+                self.default = C.DEFAULT_GATHERING
+            mode = mode or self.default
+            while self.count and self.mode != mode:
+                self.condition.wait()
+            if self.count == 0:
+                self.mode = mode
+                C.DEFAULT_GATHERING = mode
+            self.count += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.count -= 1
+                if self.count == 0:
+                    C.DEFAULT_GATHERING = self.default
+                    self.mode = None
+                    self.condition.notify_all()
+
+
+gathering_mode = GatheringMode()
+
+
+class FactCacheCallback(CallbackBase):
+    """
+    收集fact后写入FactCache
+    """
+    def __init__(self, fact_cache, *args, **kwargs):
+        super(FactCacheCallback, self).__init__(*args, **kwargs)
+        self.fact_cache = fact_cache
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        if result._task.action in ("setup", "gather_facts") and "ansible_facts" in result._result:
+            self.fact_cache.set(result._host.get_name(), result._result["ansible_facts"])
+
+
+class InventoryCache(object):
+    """
+    按清单来源缓存DataLoader、InventoryManager、VariableManager
+    清单文件(或目录下任一文件)的修改时间变化后重新解析；
+    playbook或add_host/group_by可能修改清单，这类运行结束后丢弃缓存，下次重新解析；
+    缓存正在被其他调用使用时，本次调用创建临时对象，不相互等待
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def mtimes(sources):
+        """
+        清单来源的修改时间，目录取其中最新的修改时间
+        """
+        result = []
+        for source in sources:
+            try:
+                mtime = os.stat(source).st_mtime
+            except OSError:
+                # "host1,host2," 这类非文件来源
+                result.append(None)
+                continue
+            if os.path.isdir(source):
+                for root, dirs, files in os.walk(source):
+                    for name in dirs + files:
+                        try:
+                            mtime = max(mtime, os.stat(os.path.join(root, name)).st_mtime)
+                        except OSError:
+                            pass
+            result.append(mtime)
+        return tuple(result)
+
+    @staticmethod
+    def build(sources):
+        """
+        解析清单
+        """
+        loader = DataLoader()
+        inventory_obj = InventoryManager(loader=loader, sources=sources)
+        variable_manager = VariableManager(loader=loader, inventory=inventory_obj)
+        return loader, inventory_obj, variable_manager
+
+    @staticmethod
+    def reset(loader, inventory_obj, variable_manager):
+        """
+        清理上一次运行留下的状态
+        """
+        # 只在一次运行内缓存yaml文件，playbook修改后可以重新加载
+        loader._FILE_CACHE = dict()
+        inventory_obj.remove_restriction()
+        inventory_obj.clear_caches()
+        # set_fact等非持久化变量不带到下一次运行
+        for name in ("_nonpersistent_fact_cache", "_vars_cache"):
+            cache = getattr(variable_manager, name, None)
+            if cache is not None:
+                cache.clear()
+        # 上一次运行收集的fact不带到下一次运行，与每次新建VariableManager一致(持久化的fact缓存插件仍从其存储中读取)
+        variable_manager._fact_cache = AnsibleFactCache()
+
+    @contextlib.contextmanager
+    def get(self, inventory, reusable=True):
+        """
+        获取 (loader, inventory_obj, variable_manager)
+        :param reusable: 为False时本次运行可能修改清单，结束后丢弃缓存的对象
+        """
+        sources = [inventory] if isinstance(inventory, str) else list(inventory)
+        key = tuple(sources)
+        mtimes = self.mtimes(sources)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["mtimes"] != mtimes:
+                entry = self.entries[key] = {"mtimes": mtimes, "lock": threading.Lock(), "objects": None}
+
+        if entry["lock"].acquire(False):
+            try:
+                if entry["objects"] is None:
+                    entry["objects"] = self.build(sources)
+                else:
+                    self.reset(*entry["objects"])
+                yield entry["objects"]
+            finally:
+                if not reusable:
+                    entry["objects"] = None
+                entry["lock"].release()
+        else:
+            yield self.build(sources)
+
+
+class DirectRunner(object):
+    """
+    shell/command模块的轻量执行后端，直接用paramiko执行命令，不加载Play、不打包模块、不依赖远端python
+    使用同一份清单，结果写入ResultCallback，与ansible执行的结果格式相同；
+    主机密钥按ansible的host_key_checking配置校验，ssh_config中对主机有特殊配置时交给ansible执行
+    """
+    modules = ("shell", "command")
+    # 带这些参数的任务交给ansible执行
+    unsupported_args = re.compile(r"(^|\s)(chdir|creates|removes|executable|warn|stdin|argv)=")
+    # 主机设置了这些变量时交给ansible执行
+    unsupported_vars = ("ansible_password", "ansible_ssh_pass", "ansible_become_pass", "ansible_become_password",
+                        "ansible_sudo_pass", "ansible_ssh_common_args", "ansible_ssh_extra_args")
+    # ssh_config中对主机设置了这些选项时交给ansible执行，paramiko不会处理
+    unsupported_ssh_options = ("proxyjump", "proxycommand", "user", "identityfile", "port", "hostname")
+    # command模块对每个参数做 os.path.expandvars 和 os.path.expanduser
+    env_var = re.compile(r"\$(\w+|\{\w+\})")
+    home_prefix = re.compile(r"^~[\w.-]*(/|$)")
+
+    def __init__(self, private_key_file="~/.ssh/id_rsa", forks=10, remote_user="root", become_user="root",
+                 ssh_config_files=("~/.ssh/config", "/etc/ssh/ssh_config")):
+        self.private_key_file = os.path.expanduser(private_key_file)
+        self.forks = forks
+        self.remote_user = remote_user
+        self.become_user = become_user
+        self.host_key_check = C.HOST_KEY_CHECKING
+        self.ssh_config = paramiko.SSHConfig()
+        for path in ssh_config_files:
+            path = os.path.expanduser(path)
+            if os.path.exists(path):
+                with open(path) as fp:
+                    self.ssh_config.parse(fp)
+
+    def supports(self, module, args):
+        """
+        任务是否可以直接执行
+        """
+        return module in self.modules and bool(args) and self.unsupported_args.search(args) is None
+
+    def host_params(self, variable_manager, host):
+        """
+        从清单变量中取出连接参数，不支持时返回None
+        """
+        host_vars = variable_manager.get_vars(host=host, include_hostvars=False)
+        if host_vars.get("ansible_connection", "smart") not in ("smart", "ssh", "paramiko"):
+            return None
+        if host_vars.get("ansible_become_method", "sudo") != "sudo" or \
+                host_vars.get("ansible_become_user", self.become_user) != self.become_user:
+            return None
+        if any(name in host_vars for name in self.unsupported_vars):
+            return None
+        ip = host_vars.get("ansible_host") or host_vars.get("ansible_ssh_host") or host.name
+        options = self.ssh_config.lookup(ip)
+        if options.get("hostname", ip) != ip or \
+                any(name in options for name in self.unsupported_ssh_options if name != "hostname"):
+            return None
+        return dict(
+            name=host.name,
+            ip=ip,
+            port=int(host_vars.get("ansible_port") or host_vars.get("ansible_ssh_port") or 22),
+            user=host_vars.get("ansible_user") or host_vars.get("ansible_ssh_user") or self.remote_user,
+            private_key_file=os.path.expanduser(
+                host_vars.get("ansible_ssh_private_key_file") or self.private_key_file),
+        )
+
+    def quote_arg(self, arg):
+        """
+        把command模块的一个参数转为shell中的一个词，与ansible的行为一致：
+        只展开 $VAR、${VAR} 和开头的 ~，未定义的变量保持原样，其余字符按字面传递
+        """
+        words = []
+        match = self.home_prefix.match(arg)
+        if match:
+            # ~ 和其后的 / 不能加引号，否则shell不展开
+            words.append(match.group(0))
+            arg = arg[match.end():]
+        pos = 0
+        for match in self.env_var.finditer(arg):
+            if match.start() > pos:
+                words.append(shlex.quote(arg[pos:match.start()]))
+            name = match.group(1).strip("{}")
+            literal = match.group(0).replace("$", "\\$").replace("}", "\\}")
+            words.append('"${%s-%s}"' % (name, literal))
+            pos = match.end()
+        if pos < len(arg) or not words:
+            words.append(shlex.quote(arg[pos:]))
+        return "".join(words)
+
+    def command(self, module, args, user):
+        """
+        生成远端执行的命令，command模块不经过shell解释，只展开变量和~，与ansible的行为一致
+        """
+        if module == "command":
+            args = " ".join(self.quote_arg(arg) for arg in shlex.split(args))
+        cmd = "/bin/sh -c %s" % shlex.quote(args)
+        if user != self.become_user:
+            cmd = "sudo -H -S -n -u %s %s" % (self.become_user, cmd)
+        return cmd
+
+    def run_host(self, params, module, args):
+        """
+        在一台主机上执行
+        :return: (主机名, 事件, 结果信息)
+        """
+        ssh_tty = SshTty(user=params["user"], ip=params["ip"], port=params["port"],
+                         private_key_file=params["private_key_file"], host_key_check=self.host_key_check)
+        try:
+            result = ssh_tty.run_command(self.command(module, args, params["user"]))
+        except Exception as error:
+            return params["name"], "unreachable", "Failed to connect to the host via ssh: %s" % error
+        if result is None:
+            return params["name"], "unreachable", "Failed to connect to the host via ssh"
+        status, stdout, stderr = result
+        if status == 0:
+            return params["name"], "ok", stdout.rstrip("\r\n")
+        return params["name"], "failed", stderr.rstrip("\r\n") or "non-zero return code"
+
+    def run(self, host_params, module, args, callback):
+        """
+        并发执行，结果写入callback
+        :return: result_code，与TaskQueueManager的返回值含义相同
+        """
+        if not host_params:
+            return 0
+        pool = ThreadPool(processes=max(1, min(self.forks, len(host_params))))
+        try:
+            results = pool.map(lambda params: self.run_host(params, module, args), host_params)
+        finally:
+            pool.close()
+            pool.join()
+
+        targets = {"ok": callback.host_ok, "failed": callback.host_failed, "unreachable": callback.host_unreachable}
+        for name, event, message in results:
+            targets[event][name] = message
+        if any(event == "unreachable" for name, event, message in results):
+            return TaskQueueManager.RUN_UNREACHABLE_HOSTS
+        if any(event == "failed" for name, event, message in results):
+            return TaskQueueManager.RUN_FAILED_HOSTS
+        return TaskQueueManager.RUN_OK
 
 
 class AnsibleApi(object):
-    def __init__(self, private_key_file="~/.ssh/id_rsa", results_callback=None):
+    # 所有实例共用清单缓存
+    inventory_cache = InventoryCache()
+
+    def __init__(self, private_key_file="~/.ssh/id_rsa", results_callback=None, cache_inventory=True, forks=10,
+                 fact_cache=None, fast=False, control_persist=600, control_path_dir="~/.ansible/fast-cp", timeout=5,
+                 direct=False):
+        """
+        :param direct: shell/command模块的Ad-Hoc任务用DirectRunner直接执行，清单变量、ssh_config或任务参数不支持时
+                       仍用ansible执行；连接失败(如私钥或主机密钥不可用)时报告为unreachable，不会退回ansible
+        :param fast: 快速连接模式，开启pipelining，ssh连接通过ControlPersist保持，重复执行时复用已有连接；
+                     pipelining下使用sudo需要远端关闭requiretty
+        :param control_persist: 快速模式下ssh主连接空闲保持的秒数
+        :param control_path_dir: 快速模式下ssh控制socket的目录
+        :param timeout: 快速模式下的ssh连接超时秒数
+        """
         self.private_key_file = private_key_file
+        self.cache_inventory = cache_inventory
+        self.forks = forks
+        # 设置FactCache后playbook只对fact过期的主机收集fact
+        self.fact_cache = fact_cache
+        self.fast = fast
+        self.control_persist = control_persist
+        self.control_path_dir = os.path.expanduser(control_path_dir)
+        self.timeout = timeout if fast else None
+        self.direct_runner = DirectRunner(private_key_file, forks) if direct else None
 
         # 实例化回调插件对象
         self.results_callback = results_callback if results_callback else ResultCallback()
 
-    def runner(self, inventory, hosts="localhost", module="ping", args=""):
+    def runner(self, inventory, hosts="localhost", module="ping", args="", profile=False):
         """
         类似Ad-Hoc命令
         :param inventory: 一个清单文件，一行一个ip就行
         :param hosts
         :param module:
         :param args:
+        :param profile: 为True时额外返回任务和主机的耗时报告
         :return:
         """
+        if not profile:
+            result_code = self.run_direct(inventory, hosts, module, args)
+            if result_code is not None:
+                # result_code 等于0代表任务全部运行成功
+                return result_code, self.collect_result()
+
+        profile_callback = ProfileCallback() if profile else None
+        result_code = self.run_adhoc(inventory, hosts, module, args, self.results_callback,
+                                     [profile_callback] if profile else [])
+
+        # result_code 等于0代表任务全部运行成功
+        if profile:
+            return result_code, self.collect_result(), profile_callback.report()
+        return result_code, self.collect_result()
+
+    def run_direct(self, inventory, hosts, module, args):
+        """
+        用DirectRunner执行Ad-Hoc任务
+        :return: result_code，不能直接执行时返回None
+        """
+        if self.direct_runner is None or not isinstance(self.results_callback, ResultCallback):
+            return None
+        if not self.direct_runner.supports(module, args):
+            return None
+        with self.get_inventory(inventory) as (loader, inventory_obj, variable_manager):
+            host_params = []
+            for host in inventory_obj.get_hosts(hosts):
+                params = self.direct_runner.host_params(variable_manager, host)
+                if params is None:
+                    return None
+                host_params.append(params)
+        return self.direct_runner.run(host_params, module, args, self.results_callback)
+
+    def run_adhoc(self, inventory, hosts, module, args, callback, extra_callbacks=()):
+        """
+        执行Ad-Hoc任务，结果交给callback处理
+        """
         Options = namedtuple(
             "Options",
             [
@@ -79,12 +636,13 @@ class AnsibleApi(object):
                 "become_user",
                 "check",
                 "diff",
+                "timeout",
             ],
         )
         options = Options(
             connection="smart",
             module_path=None,
-            forks=10,
+            forks=self.forks,
             private_key_file=self.private_key_file,  # 你的私钥
             remote_user="root",  # 远程用户
             become=True,
@@ -92,65 +650,86 @@ class AnsibleApi(object):
             become_user="root",
             check=False,
             diff=False,
+            timeout=self.timeout,
         )
-        # 主要加载设置的变量
-        loader = DataLoader()
         # 一个密码参数，可以设置为None，默认即可，没什么影响，我用的是秘钥登录
         passwords = dict(vault_pass="secret")
 
-        # 设置传入的机器清单
-        inventory_obj = InventoryManager(loader=loader, sources=inventory)
-
-        # 加载之前的变量
-        variable_manager = VariableManager(loader=loader, inventory=inventory_obj)
-
         play_source = dict(
             name="Ansible Ad-Hoc",
             hosts=hosts,
             gather_facts="no",
+            vars=self.connection_vars(),
             tasks=[dict(action=dict(module=module, args=args), register="shell_out"),],
         )
-        play = Play().load(
-            play_source, variable_manager=variable_manager, loader=loader
-        )
 
-        tqm = None
-        try:
-            tqm = TaskQueueManager(
-                inventory=inventory_obj,
-                variable_manager=variable_manager,
-                loader=loader,
-                options=options,
-                passwords=passwords,
-                stdout_callback=self.results_callback,
+        # 设置传入的机器清单，loader主要加载设置的变量，variable_manager加载之前的变量
+        reusable = module not in ("add_host", "group_by")
+        with self.get_inventory(inventory, reusable) as (loader, inventory_obj, variable_manager):
+            play = Play().load(
+                play_source, variable_manager=variable_manager, loader=loader
             )
-            result_code = tqm.run(play)
-        finally:
-            if tqm is not None:
-                tqm.cleanup()
-            shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
 
-        result_raw = {"success": {}, "failed": {}, "unreachable": {}}
-
-        for host, result in self.results_callback.host_ok.items():
-            result_raw["success"][host] = json.dumps(result._result)
-        for host, result in self.results_callback.host_unreachable.items():
-            result_raw["unreachable"][host] = result._result['msg']
-        for host, result in self.results_callback.host_failed.items():
-            result_raw["failed"][host] = result._result['msg']
+            tqm = None
+            try:
+                tqm = TaskQueueManager(
+                    inventory=inventory_obj,
+                    variable_manager=variable_manager,
+                    loader=loader,
+                    options=options,
+                    passwords=passwords,
+                    stdout_callback=callback,
+                )
+                tqm._callback_plugins.extend(extra_callbacks)
+                return tqm.run(play)
+            finally:
+                if tqm is not None:
+                    tqm.cleanup()
+                shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
 
+    def collect_result(self):
+        """
+        把ResultCallback收集的结果整理为result_raw
+        """
+        return {
+            "success": dict(self.results_callback.host_ok),
+            "failed": dict(self.results_callback.host_failed),
+            "unreachable": dict(self.results_callback.host_unreachable),
+        }
 
-        # result_code 等于0代表任务全部运行成功
-        return result_code, result_raw
-
+    @contextlib.contextmanager
+    def get_inventory(self, inventory, reusable=True):
+        """
+        获取 (loader, inventory_obj, variable_manager)，cache_inventory为False时每次重新解析
+        :param reusable: 为False时本次运行可能修改清单(playbook、add_host、group_by)，运行结束后不再复用
+        """
+        if self.cache_inventory:
+            with self.inventory_cache.get(inventory, reusable) as objects:
+                yield objects
+        else:
+            yield InventoryCache.build(inventory)
 
-    def runner_playbook(self, playbooks, inventory):
+    def runner_playbook(self, playbooks, inventory, profile=False):
         """
         运行playbook
         :param playbooks: playbook的路径
         :param inventory:
+        :param profile: 为True时额外返回任务和主机的耗时报告
         :return:
         """
+        profile_callback = ProfileCallback() if profile else None
+        result_code = self.run_playbook(playbooks, inventory, self.results_callback,
+                                        [profile_callback] if profile else [])
+
+        # result_code 等于0代表任务全部运行成功
+        if profile:
+            return result_code, self.collect_result(), profile_callback.report()
+        return result_code, self.collect_result()
+
+    def run_playbook(self, playbooks, inventory, callback, extra_callbacks=()):
+        """
+        执行playbook，结果交给callback处理
+        """
         if isinstance(playbooks, str):
             playbooks = [playbooks]
         Options = namedtuple(
@@ -170,12 +749,13 @@ class AnsibleApi(object):
                 "listtags",
                 "syntax",
                 "verbosity",
+                "timeout",
             ],
         )
         options = Options(
             connection="smart",
             module_path=None,
-            forks=10,
+            forks=self.forks,
             private_key_file=self.private_key_file,  # 你的私钥
             become=True,
             become_method="sudo",
@@ -187,44 +767,199 @@ class AnsibleApi(object):
             listtags=None,
             syntax=None,
             verbosity=1,  # >= 4 时展示详细调试信息
+            timeout=self.timeout,
 
         )
 
-        loader = DataLoader()
         passwords = dict(vault_pass="secret")
-        inventory_obj = InventoryManager(loader=loader, sources=inventory)
-        variable_manager = VariableManager(loader=loader, inventory=inventory_obj)
 
-        executor = PlaybookExecutor(
-            playbooks=playbooks,
-            inventory=inventory_obj,
-            variable_manager=variable_manager,
-            loader=loader,
-            options=options,
-            passwords=passwords,
-        )
+        with self.get_inventory(inventory, reusable=False) as (loader, inventory_obj, variable_manager):
+            executor = PlaybookExecutor(
+                playbooks=playbooks,
+                inventory=inventory_obj,
+                variable_manager=variable_manager,
+                loader=loader,
+                options=options,
+                passwords=passwords,
+            )
 
-        if self.results_callback:
-            executor._tqm._callback_plugins.append(self.results_callback)
+            if callback:
+                executor._tqm._callback_plugins.append(callback)
+            executor._tqm._callback_plugins.extend(extra_callbacks)
 
-        executor._tqm._gather_facts = False
+            # VariableManager可能被清单缓存复用，执行完恢复extra_vars
+            extra_vars = variable_manager.extra_vars
+            variable_manager.extra_vars = dict(extra_vars, **self.connection_vars())
+            try:
+                if self.fact_cache is None:
+                    executor._tqm._gather_facts = False
+                    with gathering_mode.use():
+                        return executor.run()
 
-        result_code = executor.run()
+                self.fact_cache.load(inventory_obj, variable_manager)
+                executor._tqm._callback_plugins.append(FactCacheCallback(self.fact_cache))
+                with gathering_mode.use("smart"):
+                    return executor.run()
+            finally:
+                variable_manager.extra_vars = extra_vars
 
-        result_raw = {"success": {}, "failed": {}, "unreachable": {}}
+    def connection_vars(self):
+        """
+        快速模式下的连接变量，作为本次运行的play变量传给ssh连接插件，优先级高于ansible.cfg，
+        不修改进程的环境变量，并发的普通运行不受影响
+        """
+        if not self.fast:
+            return {}
+        if os.path.exists(self.control_path_dir) is False:
+            os.makedirs(self.control_path_dir, mode=0o700)
+        return {
+            "ansible_ssh_pipelining": True,
+            "ansible_pipelining": True,
+            "ansible_ssh_args": "-C -o ControlMaster=auto -o ControlPersist=%ds" % self.control_persist,
+            "ansible_control_path_dir": self.control_path_dir,
+        }
+
+    def runner_sharded(self, inventory, hosts="localhost", module="ping", args="", shards=None, forks=None):
+        """
+        分片并行执行Ad-Hoc命令，主机切分为多个分片，每个分片在独立进程中运行自己的TaskQueueManager
+        :param shards: 分片数，默认根据主机数和CPU数计算
+        :param forks: 每个分片的并发数，默认根据分片大小计算
+        :return: 与runner相同的 result_code, result_raw
+        """
+        with self.get_inventory(inventory) as (loader, inventory_obj, variable_manager):
+            host_names = [host.name for host in inventory_obj.get_hosts(hosts)]
 
-        for host, result in self.results_callback.host_ok.items():
-            result_raw['success'][host] = json.dumps(result._result)
+        result_code = 0
+        result_raw = {"success": {}, "failed": {}, "unreachable": {}}
+        if not host_names:
+            return result_code, result_raw
 
-        for host, result in self.results_callback.host_failed.items():
-            result_raw['failed'][host] = result._result['msg']
+        shards, forks = shard_plan(len(host_names), shards, forks)
+        result_queue = multiprocessing.Queue()
+        # ansible的worker需要fork子进程，所以不能用multiprocessing.Pool的daemon进程
+        processes = []
+        for index in range(shards):
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(result_queue, index, self.private_key_file, inventory, host_names[index::shards], module, args,
+                      forks, self.fast),
+            )
+            process.start()
+            processes.append(process)
 
-        for host, result in self.results_callback.host_unreachable.items():
-            result_raw['unreachable'][host] = result._result['msg']
+        # 先取结果再join，避免结果太大时子进程阻塞在写队列上；
+        # 子进程被杀或崩溃时不会放入结果，轮询时检查进程状态，退出后仍没有结果的分片主机记为失败
+        pending = set(range(shards))
+        exited = set()
+        while pending:
+            try:
+                index, shard_code, shard_raw = result_queue.get(timeout=1)
+            except queue.Empty:
+                # 进程退出后再等一轮，结果可能还在管道中
+                for index in exited & pending:
+                    pending.discard(index)
+                    result_code |= TaskQueueManager.RUN_FAILED_HOSTS
+                    for host in host_names[index::shards]:
+                        result_raw["failed"][host] = "shard exited with code %s" % processes[index].exitcode
+                exited = set(index for index in pending if processes[index].exitcode is not None)
+                continue
+            pending.discard(index)
+            result_code |= shard_code
+            for key in result_raw:
+                result_raw[key].update(shard_raw[key])
+        for process in processes:
+            process.join()
 
         # result_code 等于0代表任务全部运行成功
         return result_code, result_raw
 
+    def iter_runner(self, inventory, hosts="localhost", module="ping", args="", queue_size=1000):
+        """
+        流式执行Ad-Hoc命令，每台主机有结果就立即返回
+        :return: 事件迭代器，最后一个事件为 {"event": "end", "result_code": ...}
+        """
+        callback = StreamCallback(queue_size=queue_size)
+        return self.iter_events(callback, self.run_adhoc, inventory, hosts, module, args, callback)
+
+    def iter_runner_playbook(self, playbooks, inventory, queue_size=1000):
+        """
+        流式运行playbook
+        """
+        callback = StreamCallback(queue_size=queue_size)
+        return self.iter_events(callback, self.run_playbook, playbooks, inventory, callback)
+
+    @staticmethod
+    def iter_events(callback, func, *args):
+        """
+        在后台线程中执行ansible，当前线程从队列中取出事件
+        """
+        outcome = {}
+
+        def target():
+            try:
+                outcome["result_code"] = func(*args)
+            except Exception as error:
+                outcome["error"] = error
+            finally:
+                callback.put(None)
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                event = callback.queue.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            # 消费者提前退出时不再阻塞ansible
+            callback.stopped = True
+
+        thread.join()
+        if "error" in outcome:
+            raise outcome["error"]
+        yield {"event": "end", "result_code": outcome["result_code"]}
+
+
+def shard_plan(host_count, shards=None, forks=None, hosts_per_shard=100, max_forks=50):
+    """
+    根据主机数和CPU数计算分片数和每个分片的并发数
+    """
+    if shards is None:
+        shards = min(multiprocessing.cpu_count(), int(math.ceil(host_count / float(hosts_per_shard))))
+    shards = max(1, min(shards, host_count))
+    if forks is None:
+        forks = min(max_forks, int(math.ceil(host_count / float(shards))))
+    return shards, max(1, forks)
+
+
+def run_shard(result_queue, index, private_key_file, inventory, hosts, module, args, forks, fast=False):
+    """
+    在子进程中执行一个分片，结果为 (分片序号, result_code, result_raw)
+    """
+    # 每个分片使用自己的本地临时目录，避免先结束的分片删除其他分片正在使用的目录
+    C.DEFAULT_LOCAL_TMP = tempfile.mkdtemp(prefix="ansible-local-shard-")
+    try:
+        api = AnsibleApi(private_key_file=private_key_file, forks=forks, fast=fast)
+        result_queue.put((index,) + tuple(api.runner(inventory, ",".join(hosts), module, args)))
+    except Exception as error:
+        result_queue.put((index, 1, {"success": {}, "failed": {host: str(error) for host in hosts}, "unreachable": {}}))
+
+
+def write_jsonl(events, fp):
+    """
+    把事件以JSON Lines格式写入文件
+    :return: result_code
+    """
+    result_code = None
+    for event in events:
+        fp.write(json.dumps(event) + "\n")
+        fp.flush()
+        if event["event"] == "end":
+            result_code = event["result_code"]
+    return result_code
+
 
 class TestAnsibleApi(unittest.TestCase):
     """Ansible工具类单元测试"""
@@ -248,6 +983,101 @@ class TestAnsibleApi(unittest.TestCase):
         self.assertTrue(r)
         self.assertEqual(code, 0)
 
+    def test_ansible_iter_runner(self):
+        events = list(self.factory.iter_runner("/tmp/host", "test-group", "shell", "ls -l /"))
+
+        print(events)
+        self.assertEqual(events[-1]["event"], "end")
+        self.assertTrue(events[:-1])
+
+    def test_ansible_runner_sharded(self):
+        code, ret = self.factory.runner_sharded("/tmp/host", "test-group", "shell", "ls -l /", shards=2)
+
+        print(ret)
+        r = ret['success'] or ret['failed'] or ret['unreachable']
+        self.assertTrue(r)
+        self.assertEqual(code, 0)
+
+    def test_shard_plan(self):
+        self.assertEqual(shard_plan(10, shards=4, forks=5), (4, 5))
+        self.assertEqual(shard_plan(3, shards=8), (3, 1))
+        shards, forks = shard_plan(3000)
+        self.assertTrue(1 <= shards <= multiprocessing.cpu_count())
+        self.assertTrue(forks <= 50)
+
+    def test_ansible_runner_profile(self):
+        code, ret, profile = self.factory.runner("/tmp/host", "test-group", "shell", "ls -l /", profile=True)
+
+        print(profile["summary"])
+        self.assertEqual(code, 0)
+        self.assertTrue(profile["slowest_hosts"])
+        self.assertEqual(len(profile["critical_path"]), 1)
+
+    def test_ansible_runner_fast(self):
+        # 不走DirectRunner，确保经过ansible的ssh连接插件
+        factory = AnsibleApi(private_key_file="/root/.ssh/id_rsa", fast=True, direct=False)
+        for _ in range(2):
+            code, ret = factory.runner("/tmp/host", "test-group", "shell", "ls -l /")
+            self.assertEqual(code, 0)
+        self.assertNotIn("ANSIBLE_SSH_ARGS", os.environ)
+        # 第二次执行复用了第一次留下的控制socket
+        self.assertTrue(os.path.isdir(factory.control_path_dir))
+        self.assertTrue(os.listdir(factory.control_path_dir))
+
+    def test_ansible_runner_direct(self):
+        direct = AnsibleApi(private_key_file="/root/.ssh/id_rsa", direct=True).runner(
+            "/tmp/host", "test-group", "command", "echo $HOME ~ '$UNDEFINED_VAR' 'a  b'")
+        ansible = self.factory.runner("/tmp/host", "test-group", "command", "echo $HOME ~ '$UNDEFINED_VAR' 'a  b'")
+        self.assertEqual(direct, ansible)
+
+    def test_direct_runner_command(self):
+        runner = DirectRunner()
+        self.assertTrue(runner.supports("shell", "ls -l /"))
+        self.assertFalse(runner.supports("shell", "chdir=/tmp ls"))
+        self.assertFalse(runner.supports("copy", "src=a dest=b"))
+        # command模块展开变量和~，不解释其他shell语法
+        self.assertEqual(runner.quote_arg("$HOME"), '"${HOME-\\$HOME}"')
+        self.assertEqual(runner.quote_arg("${HOME}/a b"), '"${HOME-\\${HOME\\}}"\'/a b\'')
+        self.assertEqual(runner.quote_arg("~/a;b"), "~/'a;b'")
+        self.assertEqual(runner.quote_arg(""), "''")
+        self.assertEqual(runner.command("command", "echo $HOME", "root"),
+                         "/bin/sh -c %s" % shlex.quote('echo "${HOME-\\$HOME}"'))
+        self.assertEqual(runner.command("shell", "id", "devops"), "sudo -H -S -n -u root /bin/sh -c id")
+
+    def test_fact_cache(self):
+        cache = FactCache(cache_dir=tempfile.mkdtemp(), ttl=60)
+        self.assertIsNone(cache.get("10.0.0.1"))
+        cache.set("10.0.0.1", {"ansible_hostname": "test"})
+        self.assertEqual(cache.get("10.0.0.1")["ansible_hostname"], "test")
+
+        # 超过ttl后过期
+        os.utime(cache.path("10.0.0.1"), (0, 0))
+        self.assertIsNone(cache.get("10.0.0.1"))
+
+    def test_inventory_cache(self):
+        cache = InventoryCache()
+        with tempfile.NamedTemporaryFile("w", suffix=".ini") as f:
+            f.write("127.0.0.1\n")
+            f.flush()
+            with cache.get(f.name) as first:
+                pass
+            with cache.get(f.name) as second:
+                pass
+            self.assertIs(first[1], second[1])
+
+            # 修改时间变化后重新解析
+            os.utime(f.name, (0, 0))
+            with cache.get(f.name) as third:
+                pass
+            self.assertIsNot(first[1], third[1])
+
+            # 可能修改清单的运行结束后重新解析
+            with cache.get(f.name, reusable=False) as fourth:
+                self.assertIs(third[1], fourth[1])
+            with cache.get(f.name) as fifth:
+                pass
+            self.assertIsNot(fourth[1], fifth[1])
+
 
 if __name__ == "__main__":
     unittest.main()
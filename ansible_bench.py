@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# python3.6 + ansible==2.7.12
+"""
+AnsibleApi 普通模式与快速连接模式的对比压测，两种模式都经过ansible执行，不使用DirectRunner
+对同一批主机重复执行Ad-Hoc命令，输出每轮耗时，以及首轮(冷连接)与后续轮次(复用连接)的平均耗时
+
+python3 ansible_bench.py -i /tmp/host --hosts test-group -m shell -a "uptime" -r 5
+"""
+import time
+import argparse
+
+from ansible_api import AnsibleApi
+
+
+def bench(api, inventory, hosts, module, args, rounds):
+    """
+    重复执行rounds轮，返回每轮耗时和成功主机数
+    """
+    results = []
+    for _ in range(rounds):
+        start = time.time()
+        code, ret = api.runner(inventory, hosts, module, args)
+        elapsed = time.time() - start
+        results.append((elapsed, len(ret["success"]), len(ret["failed"]) + len(ret["unreachable"])))
+    return results
+
+
+def report(name, results):
+    """
+    打印一种模式的结果
+    """
+    print("%s:" % name)
+    for index, (elapsed, success, failed) in enumerate(results):
+        print("    round %-3d %8.2fs  success %-5d failed %d" % (index + 1, elapsed, success, failed))
+    times = [elapsed for elapsed, success, failed in results]
+    warm = times[1:]
+    print("    first %.2fs, warm avg %s, all avg %.2fs" % (
+        times[0], "%.2fs" % (sum(warm) / len(warm)) if warm else "-", sum(times) / len(times)))
+    return times
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="AnsibleApi normal vs fast connection benchmark")
+    parser.add_argument("-i", "--inventory", required=True, help="inventory file")
+    parser.add_argument("--hosts", default="all", help="host pattern")
+    parser.add_argument("-m", "--module", default="shell", help="module name")
+    parser.add_argument("-a", "--args", default="uptime", help="module args")
+    parser.add_argument("-r", "--rounds", type=int, default=5, help="rounds of each mode")
+    parser.add_argument("-f", "--forks", type=int, default=10, help="ansible forks")
+    parser.add_argument("-k", "--private-key", default="~/.ssh/id_rsa", help="private key file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print("inventory: %s, hosts: %s, module: %s %s, rounds: %d, forks: %d" % (
+        args.inventory, args.hosts, args.module, args.args, args.rounds, args.forks))
+
+    normal = AnsibleApi(private_key_file=args.private_key, forks=args.forks, direct=False)
+    normal_times = report("normal", bench(normal, args.inventory, args.hosts, args.module, args.args, args.rounds))
+
+    fast = AnsibleApi(private_key_file=args.private_key, forks=args.forks, fast=True, direct=False)
+    fast_times = report("fast", bench(fast, args.inventory, args.hosts, args.module, args.args, args.rounds))
+
+    print("speedup: %.2fx" % ((sum(normal_times) / len(normal_times)) / (sum(fast_times) / len(fast_times))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# python3.6 + ansible==2.7.12
+"""
+AnsibleApi的后台任务队列
+提交任务后立即返回任务id，可以查询状态、进度、结果，也可以取消任务；
+任务在独立进程中执行，并发数可配置，不同用户的任务轮流调度，结果保存在本地
+"""
+
+import os
+import json
+import time
+import uuid
+import signal
+import sqlite3
+import traceback
+import unittest
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+
+from ansible_api import AnsibleApi
+
+
+def run_job(job_dir, kind, params, private_key_file, forks):
+    """
+    在子进程中执行任务，事件写入events.jsonl，结果写入result.json，执行出错时result.json中记录异常信息
+    """
+    # 独立的进程组，取消任务时连同ansible的worker进程一起结束
+    os.setpgrp()
+    result = {"result_code": None, "result_raw": {"success": {}, "failed": {}, "unreachable": {}}}
+    status_map = {"ok": "success", "failed": "failed", "unreachable": "unreachable"}
+    try:
+        api = AnsibleApi(private_key_file=private_key_file, forks=forks)
+        if kind == "runner":
+            events = api.iter_runner(**params)
+        else:
+            events = api.iter_runner_playbook(**params)
+
+        with open(os.path.join(job_dir, "events.jsonl"), "a") as fp:
+            for event in events:
+                fp.write(json.dumps(event) + "\n")
+                fp.flush()
+                if event["event"] in status_map:
+                    result["result_raw"][status_map[event["event"]]][event["host"]] = event["result"]
+                elif event["event"] == "end":
+                    result["result_code"] = event["result_code"]
+    except Exception:
+        result["error"] = traceback.format_exc()
+
+    result_file = os.path.join(job_dir, "result.json")
+    with open(result_file + ".tmp", "w") as fp:
+        json.dump(result, fp)
+    os.rename(result_file + ".tmp", result_file)
+
+
+class AnsibleJobQueue(object):
+    """
+    ansible后台任务队列
+    """
+    def __init__(self, store_dir="~/.ansible_jobs", concurrency=4, private_key_file="~/.ssh/id_rsa", forks=10):
+        self.store_dir = os.path.expanduser(store_dir)
+        self.private_key_file = private_key_file
+        self.forks = forks
+        if os.path.exists(self.store_dir) is False:
+            os.makedirs(self.store_dir)
+
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.store_dir, "jobs.db"), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, user TEXT, kind TEXT, params TEXT, status TEXT, "
+            "submitted REAL, started REAL, finished REAL, result_code INTEGER, error TEXT)"
+        )
+        # 旧版本创建的表没有error列
+        if "error" not in [row["name"] for row in self.db.execute("PRAGMA table_info(jobs)")]:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN error TEXT")
+        self.db.commit()
+
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()  # 用户 -> 等待中的任务id，按用户轮流调度
+        self.running = {}  # 任务id -> 进程
+        self.cancelled = set()
+        self.stopped = False
+
+        self.recover()
+        self.workers = []
+        for _ in range(concurrency):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def execute(self, sql, args=()):
+        """
+        执行sql
+        """
+        with self.db_lock:
+            cursor = self.db.execute(sql, args)
+            self.db.commit()
+            return cursor.fetchall()
+
+    def recover(self):
+        """
+        上次退出时还在运行的任务标记为中断，等待中的任务重新排队
+        """
+        self.execute("UPDATE jobs SET status = 'interrupted', finished = ? WHERE status = 'running'", (time.time(), ))
+        for row in self.execute("SELECT id, user FROM jobs WHERE status = 'pending' ORDER BY submitted"):
+            self.pending.setdefault(row["user"], deque()).append(row["id"])
+
+    def submit(self, kind, params, user):
+        """
+        保存任务并放入调度队列
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.store_dir, job_id))
+        self.execute(
+            "INSERT INTO jobs (id, user, kind, params, status, submitted) VALUES (?, ?, ?, ?, 'pending', ?)",
+            (job_id, user, kind, json.dumps(params), time.time()),
+        )
+        with self.condition:
+            self.pending.setdefault(user, deque()).append(job_id)
+            self.condition.notify()
+        return job_id
+
+    def submit_runner(self, inventory, hosts="localhost", module="ping", args="", user="default"):
+        """
+        提交Ad-Hoc任务
+        :return: 任务id
+        """
+        params = dict(inventory=inventory, hosts=hosts, module=module, args=args)
+        return self.submit("runner", params, user)
+
+    def submit_playbook(self, playbooks, inventory, user="default"):
+        """
+        提交playbook任务
+        :return: 任务id
+        """
+        params = dict(playbooks=playbooks, inventory=inventory)
+        return self.submit("playbook", params, user)
+
+    def next_job(self):
+        """
+        按用户轮流取出下一个任务
+        """
+        with self.condition:
+            while not self.stopped:
+                if self.pending:
+                    user, jobs = self.pending.popitem(last=False)
+                    job_id = jobs.popleft()
+                    if jobs:
+                        # 该用户还有任务，排到队尾
+                        self.pending[user] = jobs
+                    return job_id
+                self.condition.wait()
+        return None
+
+    def work(self):
+        """
+        工作线程，在子进程中执行任务并记录结果
+        """
+        while True:
+            job_id = self.next_job()
+            if job_id is None:
+                return
+            row = self.execute("SELECT kind, params FROM jobs WHERE id = ?", (job_id, ))[0]
+            job_dir = os.path.join(self.store_dir, job_id)
+
+            process = multiprocessing.Process(
+                target=run_job,
+                args=(job_dir, row["kind"], json.loads(row["params"]), self.private_key_file, self.forks),
+            )
+            with self.condition:
+                if job_id in self.cancelled:
+                    continue
+                process.start()
+                self.running[job_id] = process
+            self.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), job_id))
+            process.join()
+
+            with self.condition:
+                self.running.pop(job_id, None)
+                cancelled = job_id in self.cancelled
+            result = self.load_result(job_id)
+            error = None
+            if cancelled:
+                status, result_code = "cancelled", None
+            elif result is None:
+                # 子进程被杀或崩溃，没有写出结果
+                status, result_code = "error", None
+                error = "job process exited with code %s" % process.exitcode
+            elif result.get("error"):
+                status, result_code, error = "error", None, result["error"]
+            else:
+                status, result_code = "finished", result["result_code"]
+            self.execute(
+                "UPDATE jobs SET status = ?, finished = ?, result_code = ?, error = ? WHERE id = ?",
+                (status, time.time(), result_code, error, job_id),
+            )
+
+    def load_result(self, job_id):
+        """
+        读取任务结果文件
+        """
+        try:
+            with open(os.path.join(self.store_dir, job_id, "result.json")) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def progress(self, job_id):
+        """
+        统计已经返回结果的主机
+        """
+        progress = {"ok": 0, "failed": 0, "unreachable": 0, "skipped": 0}
+        try:
+            with open(os.path.join(self.store_dir, job_id, "events.jsonl")) as fp:
+                for line in fp:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if event["event"] in progress:
+                        progress[event["event"]] += 1
+        except (IOError, OSError):
+            pass
+        return progress
+
+    def status(self, job_id):
+        """
+        查询任务状态和进度，执行出错时error为异常信息
+        :return: 任务信息字典，任务不存在时返回None
+        """
+        rows = self.execute("SELECT * FROM jobs WHERE id = ?", (job_id, ))
+        if not rows:
+            return None
+        job = dict(rows[0])
+        job["params"] = json.loads(job["params"])
+        job["progress"] = self.progress(job_id)
+        return job
+
+    def result(self, job_id):
+        """
+        获取任务结果
+        :return: result_code, result_raw，任务未完成时返回None
+        """
+        job = self.status(job_id)
+        if job is None or job["status"] != "finished":
+            return None
+        result = self.load_result(job_id)
+        return result["result_code"], result["result_raw"]
+
+    def cancel(self, job_id):
+        """
+        取消等待中或运行中的任务
+        :return: 是否取消成功
+        """
+        with self.condition:
+            for user, jobs in list(self.pending.items()):
+                if job_id in jobs:
+                    jobs.remove(job_id)
+                    if not jobs:
+                        del self.pending[user]
+                    self.cancelled.add(job_id)
+                    self.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?",
+                                 (time.time(), job_id))
+                    return True
+
+            process = self.running.get(job_id)
+            if process is None:
+                return False
+            self.cancelled.add(job_id)
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            process.terminate()
+        return True
+
+    def shutdown(self):
+        """
+        停止调度，正在运行的任务继续执行完
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+
+class TestAnsibleJobQueue(unittest.TestCase):
+    """Ansible任务队列单元测试"""
+
+    def setUp(self):
+        self.jobs = AnsibleJobQueue(store_dir="/tmp/ansible_jobs", concurrency=2,
+                                    private_key_file="/root/.ssh/id_rsa")
+
+    def tearDown(self):
+        self.jobs.shutdown()
+
+    def test_submit_runner(self):
+        job_id = self.jobs.submit_runner("/tmp/host", "test-group", "shell", "ls -l /")
+        while self.jobs.status(job_id)["status"] in ("pending", "running"):
+            time.sleep(1)
+
+        code, ret = self.jobs.result(job_id)
+        print(self.jobs.status(job_id))
+        r = ret['success'] or ret['failed'] or ret['unreachable']
+        self.assertTrue(r)
+        self.assertEqual(code, 0)
+        self.assertFalse(self.jobs.cancel(job_id))
+
+    def test_submit_error(self):
+        job_id = self.jobs.submit_playbook(["/tmp/not_exists.yml"], "/tmp/host")
+        while self.jobs.status(job_id)["status"] in ("pending", "running"):
+            time.sleep(1)
+
+        job = self.jobs.status(job_id)
+        self.assertEqual(job["status"], "error")
+        self.assertTrue(job["error"])
+        self.assertIsNone(self.jobs.result(job_id))
+
+
+if __name__ == "__main__":
+    unittest.main()
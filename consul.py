@@ -2,12 +2,42 @@
 # -*- coding: utf-8 -*-
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import json
+import time
 import uuid
+import threading
+from multiprocessing.pool import ThreadPool
+from urllib.parse import urlparse
+
+# consul单个事务最多64个操作
+TXN_MAX_OPS = 64
+
+# 幂等的请求失败后可以重试，catalog的register/deregister都是PUT
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+
+def make_retry(retries, backoff_factor):
+    """
+    连接失败、读取失败以及502/503/504时按指数退避重试，只重试幂等的请求
+    """
+    kwargs = dict(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+                  status_forcelist=(502, 503, 504), raise_on_status=False)
+    try:
+        return Retry(allowed_methods=IDEMPOTENT_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
 
 
 class PyConsul(object):
-    def __init__(self, host, port, token):
+    def __init__(self, host, port, token, pool_size=10, retries=3, backoff_factor=0.2):
+        """
+        :param pool_size: 到consul的长连接池大小，并发请求超过时多出的连接用完即关闭
+        :param retries: 幂等请求的重试次数
+        :param backoff_factor: 重试间隔为 backoff_factor * 2 ** (重试次数 - 1) 秒
+        """
         self.host = host
         self.port = port
         self.token = token
@@ -16,9 +46,82 @@ class PyConsul(object):
             "X-Consul-Token": self.token
         }
 
+        # 所有请求共用一个session，复用keep-alive连接
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=make_retry(retries, backoff_factor))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # "方法 路径" -> 调用次数、失败次数、总耗时、最大耗时
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+
+    def record(self, method, url, seconds, status):
+        """
+        记录一次调用的耗时，路径只保留前三段，如 /v1/catalog/service/xxx 记为 /v1/catalog/service
+        """
+        path = "/".join(urlparse(url or "").path.split("/")[:4])
+        key = "{} {}".format(method.upper(), path)
+        with self.stats_lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0}
+            stats["count"] += 1
+            stats["errors"] += status
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def get_stats(self):
+        """
+        各接口的调用统计
+        """
+        with self.stats_lock:
+            return {key: dict(value) for key, value in self.stats.items()}
+
+    def blocking_get(self, url, index=0, wait=300, stale=False, session=None):
+        """
+        blocking query, returns when the result changes after index or wait seconds passed
+        :param session: 长轮询占用连接的时间长，可以传入独立的session，不占用普通请求的连接池
+        :return: (status, result, X-Consul-Index)
+        """
+        params = {"index": index, "wait": "{}s".format(wait)}
+        if stale:
+            params["stale"] = ""
+        start = time.time()
+        # consul会在wait上随机增加最多wait/16的时间
+        status, result, new_index = 1, None, index
+        try:
+            resp = (session or self.session).get(url, headers=self.headers, params=params,
+                                                 timeout=wait + wait / 16.0 + 5)
+            if resp.status_code == requests.codes.ok:
+                status, result = 0, resp.json()
+                new_index = int(resp.headers.get("X-Consul-Index", 0))
+            else:
+                result = "http code is {}, content: {}".format(resp.status_code, resp.text)
+        except Exception as error:
+            result = str(error)
+        self.record("get", url, time.time() - start, status)
+        return status, result, new_index
+
+    def watch(self, wait=300, stale=False, max_watches=256):
+        """
+        create a CatalogWatch on this agent
+        """
+        return CatalogWatch(self, wait, stale, max_watches=max_watches)
+
     def http_requests(self, method="get", url=None, headers=None, params=None, data=None, timeout=2):
+        start = time.time()
+        status, result = self.send(method, url, headers, params, data, timeout)
+        self.record(method, url, time.time() - start, status)
+        return status, result
+
+    def send(self, method, url, headers, params, data, timeout):
         try:
-            resp = requests.request(
+            resp = self.session.request(
                 method=method.lower(),
                 url=url,
                 headers=headers,
@@ -41,15 +144,17 @@ class PyConsul(object):
             return 1, "Server Response timeout"
         except requests.HTTPError:
             return 1, "Server Error"
+        except requests.exceptions.RetryError:
+            return 1, "Max retries exceeded"
         except Exception as error:
             return 1, str(error)
 
-    def register_service(self, dc, service, node, address, port, tags=[]):
+    @staticmethod
+    def service_payload(dc, service, node, address, port, tags=[]):
         """
-        add service
+        build /v1/catalog/register payload
         """
-        id = str(uuid.uuid4())
-        payload = {
+        return {
             "Datacenter": dc,
             "Node": node,
             "Address": address,
@@ -86,11 +191,19 @@ class PyConsul(object):
             },
             "SkipNodeUpdate": False
         }
+
+    def register_service(self, dc, service, node, address, port, tags=[]):
+        """
+        add service
+        """
+        id = str(uuid.uuid4())
+        payload = self.service_payload(dc, service, node, address, port, tags)
         url = "http://{}:{}/v1/catalog/register".format(self.host, self.port)
         status, result = self.http_requests(method="put", url=url,
                                             data=json.dumps(payload),
                                             headers=self.headers)
         print(status, result)
+        return status, result
 
     def list_datacenters(self):
         """
@@ -140,6 +253,7 @@ class PyConsul(object):
                                             data=json.dumps(payload),
                                             headers=self.headers)
         print(status, result)
+        return status, result
 
     def remove_service(self, service_id):
         """
@@ -151,6 +265,291 @@ class PyConsul(object):
             node = i["Node"]
             self.remove_node(dc, node, service_id)
 
+    @staticmethod
+    def register_ops(item):
+        """
+        transaction operations of one registration: node, service, check
+        """
+        payload = PyConsul.service_payload(item["dc"], item["service"], item["node"], item["address"],
+                                           item["port"], item.get("tags", []))
+        node = {
+            "Node": payload["Node"],
+            "Address": payload["Address"],
+            "Datacenter": payload["Datacenter"],
+            "TaggedAddresses": payload["TaggedAddresses"],
+            "Meta": payload["NodeMeta"],
+        }
+        return [
+            {"Node": {"Verb": "set", "Node": node}},
+            {"Service": {"Verb": "set", "Node": payload["Node"], "Service": payload["Service"]}},
+            {"Check": {"Verb": "set", "Check": payload["Check"]}},
+        ]
+
+    @staticmethod
+    def deregister_ops(item):
+        """
+        transaction operations of one deregistration, delete the node when service_id is None
+        """
+        if item.get("service_id") is None:
+            return [{"Node": {"Verb": "delete", "Node": {"Node": item["node"]}}}]
+        # 删除服务时consul会一起删除该服务的检查
+        return [{"Service": {"Verb": "delete", "Node": item["node"], "Service": {"ID": item["service_id"]}}}]
+
+    @staticmethod
+    def make_batches(items, make_ops, max_ops=TXN_MAX_OPS):
+        """
+        把操作按数据中心打包，每个事务不超过max_ops个操作，同一事务中相同节点只设置一次
+        :return: [(dc, [下标], [操作])]
+        """
+        batches = []
+        current = {}  # dc -> (下标, 操作, 已设置的节点)
+        for index, item in enumerate(items):
+            ops = make_ops(item)
+            dc = item["dc"]
+            batch = current.get(dc)
+            if batch is not None:
+                nodes = batch[2]
+                new_ops = [op for op in ops if not ("Node" in op and op["Node"]["Verb"] == "set"
+                                                    and op["Node"]["Node"]["Node"] in nodes)]
+                if len(batch[1]) + len(new_ops) > max_ops:
+                    batches.append((dc, batch[0], batch[1]))
+                    batch = None
+                else:
+                    ops = new_ops
+            if batch is None:
+                batch = current[dc] = ([], [], set())
+            batch[0].append(index)
+            batch[1].extend(ops)
+            batch[2].update(op["Node"]["Node"]["Node"] for op in ops if "Node" in op and op["Node"]["Verb"] == "set")
+        for dc, batch in current.items():
+            batches.append((dc, batch[0], batch[1]))
+        return batches
+
+    def txn(self, dc, ops):
+        """
+        commit operations in one transaction, all or nothing
+        """
+        url = "http://{}:{}/v1/txn".format(self.host, self.port)
+        return self.http_requests(method="put", url=url, params={"dc": dc},
+                                  data=json.dumps(ops), headers=self.headers, timeout=10)
+
+    def bulk(self, items, make_ops, single, concurrency):
+        """
+        按事务批量提交，事务失败(如版本不支持catalog事务、部分操作不合法)的批次逐个提交
+        :return: 与items顺序相同的 [(status, result)]
+        """
+        results = [None] * len(items)
+        pool = ThreadPool(processes=max(1, concurrency))
+
+        def commit(batch):
+            dc, indexes, ops = batch
+            status, result = self.txn(dc, ops)
+            if status == 0:
+                for index in indexes:
+                    results[index] = (0, "ok")
+                return
+            for index in indexes:
+                results[index] = single(items[index])
+
+        try:
+            pool.map(commit, self.make_batches(items, make_ops))
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def bulk_register(self, services, concurrency=8):
+        """
+        register many services through /v1/txn
+        :param services: [{"dc": ..., "service": ..., "node": ..., "address": ..., "port": ..., "tags": [...]}]
+        :param concurrency: max transactions (or single registrations) in flight
+        :return: [(status, result)], status 0 is success
+        """
+        def single(item):
+            payload = self.service_payload(item["dc"], item["service"], item["node"], item["address"],
+                                           item["port"], item.get("tags", []))
+            url = "http://{}:{}/v1/catalog/register".format(self.host, self.port)
+            return self.http_requests(method="put", url=url, data=json.dumps(payload), headers=self.headers)
+
+        return self.bulk(services, self.register_ops, single, concurrency)
+
+    def bulk_deregister(self, nodes, concurrency=8):
+        """
+        deregister many services or nodes through /v1/txn
+        :param nodes: [{"dc": ..., "node": ..., "service_id": ...}], service_id is None delete the node
+        :return: [(status, result)], status 0 is success
+        """
+        def single(item):
+            payload = {"Datacenter": item["dc"], "Node": item["node"]}
+            if item.get("service_id") is not None:
+                payload["ServiceID"] = item["service_id"]
+            url = "http://{}:{}/v1/catalog/deregister".format(self.host, self.port)
+            return self.http_requests(method="put", url=url, data=json.dumps(payload), headers=self.headers)
+
+        return self.bulk(nodes, self.deregister_ops, single, concurrency)
+
+
+class CatalogWatch(object):
+    """
+    用consul的blocking query监听目录变化，结果保存在本地缓存中，读取缓存不访问网络，变化时调用回调
+    每个监听占用一个线程和一个长连接，监听使用独立的session，不占用PyConsul普通请求的连接池，
+    监听数不超过max_watches
+    """
+    def __init__(self, consul, wait=300, stale=False, retry_interval=1, max_retry_interval=60, max_watches=256):
+        self.consul = consul
+        self.wait = wait
+        self.stale = stale
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_watches = max_watches
+        # 连接按需创建，连接池大小等于监听数上限，每个监听都能保持自己的长连接
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_watches)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.cache = {}  # key -> 最近一次结果
+        self.callbacks = {}  # key -> [callback(key, old, new)]
+        self.stops = {}  # key -> threading.Event
+        self.ready = {}  # key -> threading.Event，第一次取到结果后置位
+        self.followed = set()  # follow创建、用户没有监听的key，服务删除时由follow停止
+
+    def url(self, key):
+        if key == "services":
+            return "http://{}:{}/v1/catalog/services".format(self.consul.host, self.consul.port)
+        return "http://{}:{}/v1/catalog/service/{}".format(self.consul.host, self.consul.port, key[len("service:"):])
+
+    def add(self, key, callback=None, followed=False):
+        """
+        start watching key, a second call only adds the callback
+        :param followed: 由follow创建
+        :return: False when max_watches is reached
+        """
+        with self.lock:
+            if key in self.stops:
+                if not followed:
+                    # 用户也监听了，follow不再停止它
+                    self.followed.discard(key)
+            elif len(self.stops) >= self.max_watches:
+                print("watch {} skipped, max_watches {} reached".format(key, self.max_watches))
+                return False
+            if callback is not None:
+                self.callbacks.setdefault(key, []).append(callback)
+            if key in self.stops:
+                return True
+            if followed:
+                self.followed.add(key)
+            stop = self.stops[key] = threading.Event()
+            ready = self.ready[key] = threading.Event()
+        thread = threading.Thread(target=self.run, args=(key, stop, ready))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def remove(self, key):
+        """
+        stop watching key, the request in flight returns within wait seconds
+        """
+        with self.lock:
+            stop = self.stops.pop(key, None)
+            self.followed.discard(key)
+            self.ready.pop(key, None)
+            self.callbacks.pop(key, None)
+            self.cache.pop(key, None)
+        if stop is not None:
+            stop.set()
+
+    def run(self, key, stop, ready):
+        url = self.url(key)
+        index = 0
+        retry_interval = self.retry_interval
+        while not stop.is_set():
+            status, result, new_index = self.consul.blocking_get(url, index, self.wait, self.stale, self.session)
+            if stop.is_set():
+                return
+            if status != 0:
+                # consul不可用时退避重试
+                stop.wait(retry_interval)
+                retry_interval = min(retry_interval * 2, self.max_retry_interval)
+                continue
+            retry_interval = self.retry_interval
+
+            # index变小说明consul重建了数据，从头开始；index至少为1，否则请求不会阻塞
+            index = max(1, new_index if new_index >= index else 0)
+            with self.lock:
+                if stop.is_set():
+                    return
+                old = self.cache.get(key)
+                changed = not ready.is_set() or old != result
+                self.cache[key] = result
+                callbacks = list(self.callbacks.get(key, ()))
+            ready.set()
+            if changed:
+                for callback in callbacks:
+                    try:
+                        callback(key, old, result)
+                    except Exception as error:
+                        print("watch callback error: ", error)
+
+    def get(self, key, timeout=None):
+        """
+        read the cache, waiting at most timeout seconds for the first result
+        """
+        with self.lock:
+            ready = self.ready.get(key)
+        if ready is None or not ready.wait(timeout):
+            return None
+        with self.lock:
+            return self.cache.get(key)
+
+    def watch_services(self, callback=None, follow=False):
+        """
+        watch the service list, follow=True also watches the nodes of every service
+        """
+        if follow:
+            self.add("services", self.follow)
+        self.add("services", callback)
+
+    def watch_service(self, service_id, callback=None):
+        """
+        watch the nodes providing a service
+        """
+        self.add("service:{}".format(service_id), callback)
+
+    def follow(self, key, old, new):
+        """
+        服务列表变化时增加或停止对应服务的监听，只停止follow自己创建的监听
+        """
+        old = set(old or ())
+        new = set(new or ())
+        for service_id in new - old:
+            self.add("service:{}".format(service_id), followed=True)
+        for service_id in old - new:
+            key = "service:{}".format(service_id)
+            with self.lock:
+                followed = key in self.followed
+            if followed:
+                self.remove(key)
+
+    def list_services(self, timeout=None):
+        """
+        cached list_services
+        """
+        result = self.get("services", timeout)
+        return result.keys() if result is not None else None
+
+    def list_nodes_for_service(self, service_id, timeout=None):
+        """
+        cached list_nodes_for_service
+        """
+        result = self.get("service:{}".format(service_id), timeout)
+        return result if result is not None else []
+
+    def stop(self):
+        for key in list(self.stops):
+            self.remove(key)
+        self.session.close()
+
 
 # test
 if __name__ == '__main__':
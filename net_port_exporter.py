@@ -1,70 +1,593 @@
 import os
-import subprocess
 import time
+import gzip
+import errno
+import socket
+import struct
+import logging
 import argparse
-from prometheus_client.core import GaugeMetricFamily, REGISTRY
-from prometheus_client import make_wsgi_app
-from wsgiref.simple_server import make_server
+import threading
+import socketserver
+from collections import namedtuple, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+
+TCP_LISTEN = b"0A"
+PROC_NET_TCP = ("/proc/net/tcp", "/proc/net/tcp6")
+
+
+def parse_listen_sockets(data):
+    """
+    从/proc/net/tcp(6)的内容中取出LISTEN状态的端口和套接字inode
+    每行格式: sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ...，
+    local_address为 十六进制地址:十六进制端口
+    :return: {端口: set(inode)}
+    """
+    sockets = {}
+    for line in data.splitlines()[1:]:
+        fields = line.split(None, 10)
+        if len(fields) > 9 and fields[3] == TCP_LISTEN:
+            port = int(fields[1].rsplit(b":", 1)[1], 16)
+            inodes = sockets.setdefault(port, set())
+            inode = int(fields[9])
+            if inode:
+                inodes.add(inode)
+    return sockets
+
+
+def parse_listen_ports(data):
+    """
+    从/proc/net/tcp(6)的内容中取出LISTEN状态的端口
+    """
+    return set(parse_listen_sockets(data))
+
+
+def read_listen_sockets(paths=PROC_NET_TCP):
+    """
+    读取本机所有LISTEN状态的tcp端口和套接字inode，没有开启ipv6时忽略tcp6
+    """
+    sockets = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        for port, inodes in parse_listen_sockets(data).items():
+            sockets.setdefault(port, set()).update(inodes)
+    return sockets
+
+
+def read_listen_ports(paths=PROC_NET_TCP):
+    """
+    读取本机所有LISTEN状态的tcp端口
+    """
+    return sorted(read_listen_sockets(paths))
+
+
+class InodeIndex(object):
+    """
+    套接字inode到进程的增量索引
+    每次只扫描新出现的进程的/proc/<pid>/fd；还有inode找不到归属时，再按上次扫描时间轮流重扫老进程，
+    每轮扫描的进程数不超过budget
+    """
+    def __init__(self, budget=256, proc="/proc"):
+        self.budget = budget
+        self.proc = proc
+        self.inodes = {}  # inode -> (pid, comm)，只保存监听套接字
+        self.pids = OrderedDict()  # pid -> 该进程持有的监听inode，按扫描时间排序，最早扫描的在前
+
+    def scan(self, pid, wanted):
+        """
+        扫描一个进程的fd，记录其中属于wanted的inode
+        """
+        self.forget(pid)
+        found = set()
+        fd_dir = os.path.join(self.proc, str(pid), "fd")
+        try:
+            with open(os.path.join(self.proc, str(pid), "comm")) as f:
+                comm = f.read().strip()
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # 进程已退出或没有权限，下次进程列表变化时再处理
+            self.pids[pid] = found
+            return
+        for fd in fds:
+            try:
+                link = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if link.startswith("socket:["):
+                inode = int(link[8:-1])
+                if inode in wanted:
+                    found.add(inode)
+                    # 多个进程共享同一个监听套接字时(如nginx的worker)取最小的pid
+                    owner = self.inodes.get(inode)
+                    if owner is None or pid < owner[0]:
+                        self.inodes[inode] = (pid, comm)
+        self.pids[pid] = found
+
+    def forget(self, pid):
+        """
+        删除一个进程的索引
+        """
+        for inode in self.pids.pop(pid, ()):
+            owner = self.inodes.get(inode)
+            if owner is not None and owner[0] == pid:
+                del self.inodes[inode]
+
+    def refresh(self, wanted):
+        """
+        更新索引
+        :param wanted: 当前所有监听套接字的inode
+        """
+        pids = set(int(name) for name in os.listdir(self.proc) if name.isdigit())
+        for pid in list(self.pids):
+            if pid not in pids:
+                self.forget(pid)
+        # 已经关闭的监听套接字
+        for inode in list(self.inodes):
+            if inode not in wanted:
+                del self.inodes[inode]
+
+        budget = self.budget
+        for pid in sorted(pids - set(self.pids)):
+            if budget <= 0:
+                return
+            self.scan(pid, wanted)
+            budget -= 1
+
+        # 老进程新打开的监听套接字
+        if any(inode not in self.inodes for inode in wanted):
+            for pid in list(self.pids)[:budget]:
+                self.scan(pid, wanted)
+
+    def owner(self, inodes):
+        """
+        :return: (pid, comm)，找不到时返回 ("", "")
+        """
+        owners = [self.inodes[inode] for inode in inodes if inode in self.inodes]
+        if not owners:
+            return "", ""
+        pid, comm = min(owners)
+        return str(pid), comm
+
+
+class SockDiag(object):
+    """
+    通过netlink的sock_diag接口按状态批量导出tcp套接字，一次遍历汇总每个监听端口的连接和队列，不需要fork
+    """
+    NETLINK_SOCK_DIAG = 4
+    SOCK_DIAG_BY_FAMILY = 20
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_DUMP = 0x300
+    TCP_ESTABLISHED = 1
+    TCP_SYN_RECV = 3
+    TCP_LISTEN = 10
+
+    nlmsghdr = struct.Struct("=IHHII")
+    # inet_diag_req_v2: family, protocol, ext, pad, states, inet_diag_sockid(48字节)
+    inet_diag_req = struct.Struct("=BBBxI48x")
+    # inet_diag_msg中用到的字段: state, sport(网络字节序), rqueue, wqueue
+    diag_state = struct.Struct("=xB")
+    diag_sport = struct.Struct("!H")
+    diag_queue = struct.Struct("=II")
+
+    def __init__(self, recv_size=1024 * 1024):
+        self.recv_size = recv_size
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_SOCK_DIAG)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_size)
+
+    def close(self):
+        self.sock.close()
+
+    def dump(self, family, states):
+        """
+        导出一个地址族中指定状态的tcp套接字
+        :return: 迭代 (state, sport, rqueue, wqueue)
+        """
+        self.seq += 1
+        request = self.inet_diag_req.pack(family, socket.IPPROTO_TCP, 0, states)
+        header = self.nlmsghdr.pack(self.nlmsghdr.size + len(request), self.SOCK_DIAG_BY_FAMILY,
+                                    self.NLM_F_REQUEST | self.NLM_F_DUMP, self.seq, 0)
+        self.sock.send(header + request)
+
+        while True:
+            data = self.sock.recv(self.recv_size)
+            offset = 0
+            while offset + self.nlmsghdr.size <= len(data):
+                length, msg_type, flags, seq, pid = self.nlmsghdr.unpack_from(data, offset)
+                if length < self.nlmsghdr.size:
+                    return
+                body = offset + self.nlmsghdr.size
+                if seq != self.seq:
+                    # 上一次中断的导出留下的消息
+                    offset += (length + 3) & ~3
+                    continue
+                if msg_type == self.NLMSG_DONE:
+                    return
+                if msg_type == self.NLMSG_ERROR:
+                    code = -struct.unpack_from("=i", data, body)[0]
+                    raise OSError(code, os.strerror(code))
+                if msg_type == self.SOCK_DIAG_BY_FAMILY:
+                    state, = self.diag_state.unpack_from(data, body)
+                    sport, = self.diag_sport.unpack_from(data, body + 4)
+                    rqueue, wqueue = self.diag_queue.unpack_from(data, body + 56)
+                    yield state, sport, rqueue, wqueue
+                offset += (length + 3) & ~3
+
+    def port_stats(self):
+        """
+        按监听端口汇总
+        :return: {端口: {"established": n, "syn_recv": n, "accept_queue": n, "accept_backlog": n}}
+        """
+        states = (1 << self.TCP_ESTABLISHED) | (1 << self.TCP_SYN_RECV) | (1 << self.TCP_LISTEN)
+        listen = {}
+        counts = {}  # (状态, 本地端口) -> 连接数，内存只和端口数有关
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                for state, sport, rqueue, wqueue in self.dump(family, states):
+                    if state == self.TCP_LISTEN:
+                        # 监听套接字的rqueue是当前全连接队列长度，wqueue是backlog上限
+                        stats = listen.setdefault(sport, {"established": 0, "syn_recv": 0,
+                                                          "accept_queue": 0, "accept_backlog": 0})
+                        stats["accept_queue"] += rqueue
+                        stats["accept_backlog"] += wqueue
+                    else:
+                        key = (state, sport)
+                        counts[key] = counts.get(key, 0) + 1
+            except OSError as error:
+                # 没有开启ipv6
+                if family == socket.AF_INET6 and error.errno in (errno.ENOENT, errno.EAFNOSUPPORT):
+                    continue
+                raise
+
+        for (state, sport), count in counts.items():
+            stats = listen.get(sport)
+            if stats is None:
+                continue
+            if state == self.TCP_ESTABLISHED:
+                stats["established"] += count
+            else:
+                stats["syn_recv"] += count
+        return listen
+
+
+class PortRecord(object):
+    """
+    一个端口的状态
+    """
+    __slots__ = ("first_seen", "last_seen", "up", "ups", "downs", "owner")
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_seen = now
+        self.up = True
+        self.ups = 0  # 重新监听的次数
+        self.downs = 0  # 停止监听的次数
+        self.owner = ("", "")
+
+
+class PortHistory(object):
+    """
+    端口状态表，记录首次/最后出现时间和状态变化次数
+    丢失的端口保留ttl秒后删除，状态变化写入事件日志
+    完整采样和快速采样并发更新，读取时间早于已应用的采样时丢弃，避免旧状态覆盖新状态
+    """
+    def __init__(self, ttl=3600, event_log=None):
+        self.ttl = ttl
+        self.records = {}
+        self.lock = threading.Lock()
+        self.started = False
+        self.last_update = 0
+        self.logger = None
+        if event_log:
+            self.logger = logging.getLogger("net_port_exporter.events")
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            fh = logging.FileHandler(event_log)
+            fh.setFormatter(logging.Formatter("%(asctime)s: %(message)s"))
+            self.logger.addHandler(fh)
+
+    def event(self, port, action, record):
+        if self.logger is not None:
+            self.logger.info("port %s %s pid=%s comm=%s", port, action, record.owner[0], record.owner[1])
+
+    def update(self, ports, now, owners=None):
+        """
+        记录一次采样
+        :param ports: 当前监听的端口
+        :param now: 读取端口的时间
+        :param owners: {端口: (pid, comm)}，快速采样时为None
+        :return: 是否应用，比已应用的采样旧时返回False
+        """
+        ports = set(ports)
+        with self.lock:
+            if now < self.last_update:
+                return False
+            self.last_update = now
+            for port in ports:
+                record = self.records.get(port)
+                if record is None:
+                    record = self.records[port] = PortRecord(now)
+                    action = "listen" if self.started else None
+                elif not record.up:
+                    record.up = True
+                    record.ups += 1
+                    action = "up"
+                else:
+                    action = None
+                record.last_seen = now
+                if owners and owners.get(port, ("", ""))[0]:
+                    record.owner = owners[port]
+                if action:
+                    self.event(port, action, record)
+
+            for port, record in self.records.items():
+                if record.up and port not in ports:
+                    record.up = False
+                    record.downs += 1
+                    self.event(port, "down", record)
+            self.started = True
+        return True
+
+    def set_owners(self, owners):
+        """
+        记录端口所属进程，只更新仍在监听的端口
+        """
+        with self.lock:
+            for port, owner in owners.items():
+                record = self.records.get(port)
+                if record is not None and record.up and owner[0]:
+                    record.owner = owner
+
+    def view(self, now):
+        """
+        删除过期的端口，监听中和丢失的端口在同一次加锁中取出，同一个端口不会同时出现在两者中
+        :return: (监听中的端口, 丢失的端口, {端口: 停止监听次数}, {端口: (pid, comm)})
+        """
+        with self.lock:
+            for port, record in list(self.records.items()):
+                if not record.up and record.last_seen + self.ttl < now:
+                    del self.records[port]
+                    self.event(port, "expired", record)
+            ports = tuple(sorted(port for port, record in self.records.items() if record.up))
+            lost_ports = tuple(sorted(port for port, record in self.records.items() if not record.up))
+            downs = {port: record.downs for port, record in self.records.items()}
+            owners = {port: record.owner for port, record in self.records.items()}
+        return ports, lost_ports, downs, owners
+
+
+# 一次采样的结果，生成后不再修改，抓取时直接读取
+Snapshot = namedtuple("Snapshot", ["ports", "lost_ports", "owners", "downs", "port_stats", "success", "info",
+                                   "duration", "timestamp"])
+
+PORT_STATS = (
+    ("established", "discovery_network_tcp_port_established", "established connections of listen port"),
+    ("syn_recv", "discovery_network_tcp_port_syn_recv", "SYN-RECV connections of listen port"),
+    ("accept_queue", "discovery_network_tcp_port_accept_queue", "accept queue depth of listen port"),
+    ("accept_backlog", "discovery_network_tcp_port_accept_backlog", "accept queue backlog of listen port"),
+)
 
 
 class CustomCollector(object):
-    def __init__(self):
-        self.ports = []
-        self.old_ports = []
-        self.success = 0  # 1: success , 1: fail
-        self.info = "none"
+    """
+    后台线程按固定间隔采样，抓取只序列化最近一次的快照，
+    多个Prometheus同时抓取时结果一致，抓取耗时也不受采样影响；
+    另一个线程按fast_interval只读取监听端口，捕捉两次完整采样之间的短暂中断
+    """
+    def __init__(self, interval=15, sock_diag=True, pid_scan_budget=256, fast_interval=1, ttl=3600,
+                 event_log=None):
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.history = PortHistory(ttl, event_log)
+        # budget为0时不统计端口所属的进程
+        self.inode_index = InodeIndex(pid_scan_budget) if pid_scan_budget > 0 else None
+        self.sock_diag = None
+        if sock_diag:
+            try:
+                self.sock_diag = SockDiag()
+            except OSError as error:
+                print("sock_diag unavailable, connection metrics disabled: ", error)
+        self.snapshot = Snapshot((), (), {}, {}, {}, 0, "not sampled yet", 0, 0)  # success 1: success , 0: fail
+        self.stopped = threading.Event()
+        self.sample()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        if fast_interval > 0:
+            self.fast_thread = threading.Thread(target=self.run_fast)
+            self.fast_thread.daemon = True
+            self.fast_thread.start()
 
-    def collect(self):
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def run_fast(self):
+        while not self.stopped.wait(self.fast_interval):
+            try:
+                now = time.time()
+                self.history.update(read_listen_ports(), now)
+            except Exception:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+
+    def sample(self):
         now = time.time()
+        info = "none"
+        try:
+            sockets = read_listen_sockets()
+            success = 1
+        except Exception as error:
+            sockets = {}
+            info = str(error)
+            success = 0
+        ports = tuple(sorted(sockets))
+        # 读取后立即记录，不等进程和sock_diag查询，缩小与快速采样交错的窗口；采样失败时不把所有端口当作丢失
+        if success:
+            self.history.update(ports, now)
+
+        owners = {}
+        if self.inode_index is not None and success:
+            try:
+                self.inode_index.refresh(set().union(*sockets.values()))
+                owners = {port: self.inode_index.owner(inodes) for port, inodes in sockets.items()}
+            except OSError as error:
+                info = "pid: %s" % error
+
+        port_stats = {}
+        if self.sock_diag is not None:
+            try:
+                port_stats = self.sock_diag.port_stats()
+            except OSError as error:
+                info = "sock_diag: %s" % error
 
-        self.run_sh("ss -ntl")
-        lost_port = set(self.old_ports) - set(self.ports)
-        self.old_ports = self.ports
+        self.history.set_owners(owners)
+        # 快速采样可能在查询进程和sock_diag期间更新了端口状态，监听中的端口以状态表为准
+        history_ports, lost_ports, downs, history_owners = self.history.view(now)
+        if success:
+            ports = history_ports
+        # 丢失的端口沿用最后一次看到的进程，告警中可以看到是哪个服务
+        for port in ports + lost_ports:
+            if port not in owners or not owners[port][0]:
+                owners[port] = history_owners.get(port, ("", ""))
+        # 整体替换引用，抓取线程看到的总是完整的一次采样
+        self.snapshot = Snapshot(ports, lost_ports, owners, downs, port_stats, success, info, time.time() - now, now)
+
+    def collect(self):
+        snapshot = self.snapshot
 
-        duration = time.time() - now
         duration_seconds = GaugeMetricFamily('discovery_network_port_duration_seconds', 'duration_seconds', labels=[])
-        duration_seconds.add_metric([], duration)
+        duration_seconds.add_metric([], snapshot.duration)
         yield duration_seconds
 
+        sample_time = GaugeMetricFamily('discovery_network_port_sample_timestamp_seconds', 'last sample time',
+                                        labels=[])
+        sample_time.add_metric([], snapshot.timestamp)
+        yield sample_time
+
         job_success = GaugeMetricFamily('discovery_network_port_success', 'job result', labels=["info"])
-        job_success.add_metric([self.info], self.success)
+        job_success.add_metric([snapshot.info], snapshot.success)
         yield job_success
 
-        for port in self.ports:
-            c = GaugeMetricFamily('discovery_network_tcp_listen_port', 'listen port', labels=['port'])
-            c.add_metric([str(port)], 1)
-            yield c
+        # 所有端口放在同一个指标族中，不重复输出HELP/TYPE
+        c = GaugeMetricFamily('discovery_network_tcp_listen_port', 'listen port', labels=['port', 'pid', 'comm'])
+        for port in snapshot.ports:
+            c.add_metric([str(port)] + list(snapshot.owners.get(port, ("", ""))), 1)
+        for port in snapshot.lost_ports:
+            c.add_metric([str(port)] + list(snapshot.owners.get(port, ("", ""))), 0)
+        yield c
+
+        # 包括两次完整采样之间发生又恢复的中断
+        c = CounterMetricFamily('discovery_network_tcp_listen_port_down', 'times the port stopped listening',
+                                labels=['port'])
+        for port, downs in sorted(snapshot.downs.items()):
+            c.add_metric([str(port)], downs)
+        yield c
 
-        for port in lost_port:
-            c = GaugeMetricFamily('discovery_network_tcp_listen_port', 'listen port', labels=['port'])
-            c.add_metric([str(port)], 0)
+        for key, name, documentation in PORT_STATS:
+            c = GaugeMetricFamily(name, documentation, labels=['port'])
+            for port, stats in sorted(snapshot.port_stats.items()):
+                c.add_metric([str(port)], stats[key])
             yield c
 
-    def run_sh(self, command):
-        self.ports = []
-        self.info = "none"
-        try:
-            sub = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            pid = sub.pid
-            out_put = sub.communicate()[0]
-            status = sub.returncode
-        except Exception as error:
-            out_put = str(error)
-            self.info = str(error)
-            status = 1
 
-        if status == 0:
-            self.success = 1
-            output_lines = out_put.split("\n")
-            try:
-                for i in output_lines[1:]:
-                    ii = i.split()
-                    if len(ii) > 3:
-                        listen_port = ii[3].split(":")[1]
-                        self.ports.append(listen_port)
-            except Exception as error:
-                self.info = str(error)
-                self.success = 0
+class Exposition(object):
+    """
+    每次采样只渲染一次指标文本(和gzip压缩后的文本)，之后的抓取直接返回缓存
+    同时作为collector输出自身的渲染耗时和请求统计，这些值截止到最近一次渲染
+    """
+    def __init__(self, collector, registry=REGISTRY, compress_level=6):
+        self.collector = collector
+        self.registry = registry
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+        self.generation = None
+        self.payload = b""
+        self.payload_gzip = None
+        self.render_seconds = 0
+        self.requests = 0
+        self.request_seconds = 0
+
+    def get(self, use_gzip=False):
+        """
+        :return: 指标文本，use_gzip为True时返回压缩后的文本
+        """
+        with self.lock:
+            snapshot = self.collector.snapshot
+            if snapshot is not self.generation:
+                now = time.time()
+                self.payload = generate_latest(self.registry)
+                self.payload_gzip = None
+                self.generation = snapshot
+                self.render_seconds = time.time() - now
+            if not use_gzip:
+                return self.payload
+            if self.payload_gzip is None:
+                self.payload_gzip = gzip.compress(self.payload, self.compress_level)
+            return self.payload_gzip
+
+    def observe(self, seconds):
+        with self.lock:
+            self.requests += 1
+            self.request_seconds += seconds
+
+    def collect(self):
+        render = GaugeMetricFamily('discovery_network_port_render_duration_seconds',
+                                   'time spent rendering the exposition', labels=[])
+        render.add_metric([], self.render_seconds)
+        yield render
+
+        requests = CounterMetricFamily('discovery_network_port_http_requests', 'metrics requests served', labels=[])
+        requests.add_metric([], self.requests)
+        yield requests
+
+        latency = CounterMetricFamily('discovery_network_port_http_request_duration_seconds',
+                                      'total time spent serving metrics requests', labels=[])
+        latency.add_metric([], self.request_seconds)
+        yield latency
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    返回缓存的指标文本，客户端支持时使用gzip
+    """
+    exposition = None
+
+    def do_GET(self):
+        now = time.time()
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        use_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        payload = self.exposition.get(use_gzip)
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.exposition.observe(time.time() - now)
+
+    def log_message(self, format, *args):
+        # 不为每次抓取打印访问日志
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    每个请求一个线程，慢的抓取方不会阻塞其他请求
+    """
+    daemon_threads = True
 
 
 def parse_args():
@@ -79,6 +602,50 @@ def parse_args():
         help='Listen to this port',
         default=int(os.environ.get('VIRTUAL_PORT', '9118'))
     )
+    parser.add_argument(
+        '-i', '--interval',
+        metavar='seconds',
+        required=False,
+        type=float,
+        help='Sample interval',
+        default=float(os.environ.get('SAMPLE_INTERVAL', '15'))
+    )
+    parser.add_argument(
+        '--pid-scan-budget',
+        metavar='count',
+        required=False,
+        type=int,
+        help='Max processes whose fds are scanned per sample, 0 disables pid/comm labels',
+        default=256
+    )
+    parser.add_argument(
+        '--fast-interval',
+        metavar='seconds',
+        required=False,
+        type=float,
+        help='Interval of the listen-port-only sampler that catches short outages, 0 disables it',
+        default=1
+    )
+    parser.add_argument(
+        '--ttl',
+        metavar='seconds',
+        required=False,
+        type=float,
+        help='Seconds a lost port stays exposed as 0',
+        default=3600
+    )
+    parser.add_argument(
+        '--event-log',
+        metavar='path',
+        required=False,
+        help='Port change event log',
+        default=os.environ.get('EVENT_LOG', '/var/log/net_port_exporter/events.log')
+    )
+    parser.add_argument(
+        '--no-sock-diag',
+        action='store_true',
+        help='Disable per port connection and queue metrics',
+    )
     return parser.parse_args()
 
 
@@ -86,13 +653,25 @@ def main():
     try:
         args = parse_args()
         port = int(args.port)
-        REGISTRY.register(CustomCollector())
-        app = make_wsgi_app()
-        httpd = make_server('', port, app)
+        event_log = args.event_log
+        event_dir = os.path.dirname(event_log)
+        try:
+            if event_dir and os.path.exists(event_dir) is False:
+                os.makedirs(event_dir)
+        except OSError as error:
+            print("Unable to create event log, error message: ", error)
+            event_log = None
+        collector = CustomCollector(interval=args.interval, sock_diag=not args.no_sock_diag,
+                                    pid_scan_budget=args.pid_scan_budget, fast_interval=args.fast_interval,
+                                    ttl=args.ttl, event_log=event_log)
+        REGISTRY.register(collector)
+        exposition = Exposition(collector)
+        REGISTRY.register(exposition)
+
+        MetricsHandler.exposition = exposition
+        httpd = ThreadingHTTPServer(('', port), MetricsHandler)
+        print("Serving at port: {}".format(port))
         httpd.serve_forever()
-        print("Polling {}. Serving at port: {}".format(args.jenkins, port))
-        while True:
-            time.sleep(1)
     except KeyboardInterrupt:
         print(" Interrupted")
         exit(0)
@@ -5,10 +5,17 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 import sys
 import os
 import time
+import gzip
+import fcntl
+import atexit
+import shutil
+import threading
 import paramiko
 import signal
 import socket
 import select
+import selectors
+from multiprocessing.pool import ThreadPool
 
 
 try:
@@ -20,19 +27,208 @@ except ImportError:
     sys.exit()
 
 
+class SessionLogWriter(object):
+    """
+    A buffered session log writer
+    会话日志先写入内存缓冲区，由后台线程按大小或时间批量写盘，
+    每天零点切换到新文件，可选压缩切换前的文件；
+    多个进程会追加同一个文件，写入时持有文件的共享锁，压缩时拿到排他锁才说明没有进程还在写
+    """
+
+    def __init__(self, log_path, flush_size=64 * 1024, flush_interval=1.0, compress=False):
+        self.log_path = log_path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.buffer = []
+        self.buffer_size = 0
+        self.lock = threading.Lock()  # 保护缓冲区
+        self.io_lock = threading.Lock()  # 保护文件
+        self.event = threading.Event()
+        self.log_file = None
+        self.file = None
+        self.rollover_at = 0
+        self.closed = False
+
+        if os.path.exists(log_path) is False:
+            os.makedirs(log_path)
+        self.rollover()
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def rollover(self):
+        """
+        切换到当天的日志文件，调用方需持有io_lock
+        """
+        now = time.localtime()
+        old_file = self.log_file
+        if self.file is not None:
+            # 关闭时释放共享锁
+            self.file.close()
+        self.log_file = os.path.join(self.log_path, f"{time.strftime('%Y%m%d', now)}.his")
+        self.file = self.open_file(self.log_file)
+        # 下一个零点
+        self.rollover_at = time.mktime((now.tm_year, now.tm_mon, now.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+        # 启动时和切换后检查之前的文件，最后一个释放文件的进程会完成压缩
+        if self.compress and old_file != self.log_file:
+            thread = threading.Thread(target=self.compress_old_files, args=(self.log_path, self.log_file))
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def open_file(log_file):
+        """
+        打开日志文件并加共享锁，文件刚被压缩删除时重新创建
+        """
+        while True:
+            f = open(log_file, 'a+', encoding='utf-8')
+            fcntl.flock(f, fcntl.LOCK_SH)
+            if os.fstat(f.fileno()).st_nlink > 0:
+                return f
+            f.close()
+
+    @staticmethod
+    def compress_old_files(log_path, current_file):
+        """
+        压缩当前文件之外的日志文件
+        """
+        try:
+            names = os.listdir(log_path)
+        except OSError:
+            return
+        for name in sorted(names):
+            log_file = os.path.join(log_path, name)
+            if name.endswith('.his') and log_file != current_file:
+                SessionLogWriter.compress_file(log_file)
+
+    @staticmethod
+    def compress_file(log_file):
+        """
+        压缩已切换的日志文件，还有进程持有共享锁时跳过
+        """
+        try:
+            with open(log_file, 'rb') as src:
+                try:
+                    fcntl.flock(src, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    return
+                # 拿到锁之前文件可能已被其他进程压缩删除
+                if os.fstat(src.fileno()).st_nlink == 0:
+                    return
+                with gzip.open(log_file + '.gz', 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(log_file)
+        except (IOError, OSError):
+            pass
+
+    def write(self, x):
+        """
+        写入缓冲区，跨过零点时先把旧数据写入前一天的文件
+        """
+        if time.time() >= self.rollover_at:
+            self.flush()
+        with self.lock:
+            self.buffer.append(x)
+            self.buffer_size += len(x)
+            full = self.buffer_size >= self.flush_size
+        if full:
+            self.event.set()
+
+    def flush(self):
+        """
+        把缓冲区写入文件
+        """
+        with self.io_lock:
+            with self.lock:
+                data = ''.join(self.buffer)
+                self.buffer = []
+                self.buffer_size = 0
+            if data:
+                self.file.write(data)
+                self.file.flush()
+            if time.time() >= self.rollover_at:
+                self.rollover()
+
+    def run(self):
+        """
+        后台线程，缓冲区满或者超时后写盘
+        """
+        while not self.closed:
+            self.event.wait(self.flush_interval)
+            self.event.clear()
+            try:
+                self.flush()
+            except (IOError, OSError, ValueError):
+                pass
+
+    def close(self):
+        """
+        停止后台线程并写入剩余内容
+        """
+        self.closed = True
+        self.event.set()
+        self.flush()
+        with self.io_lock:
+            self.file.close()
+
+
+log_writer = None
+
+
+def get_log_writer(compress=None):
+    """
+    同一个进程的所有会话共用一个日志写入对象
+    :param compress: 是否压缩切换前的日志，为None时读取环境变量QSSH_LOG_COMPRESS(1/true/yes)，只在第一次创建时生效
+    """
+    global log_writer
+    if log_writer is None:
+        if compress is None:
+            compress = os.environ.get("QSSH_LOG_COMPRESS", "").lower() in ("1", "true", "yes")
+        user_home = os.environ["HOME"]
+        log_writer = SessionLogWriter(os.path.join(user_home, ".qssh"), compress=compress)
+        atexit.register(log_writer.close)
+    return log_writer
+
+
+def load_private_key(private_key_file):
+    """
+    读取私钥，依次尝试RSA、ECDSA、Ed25519、DSA
+    """
+    private_key_file = os.path.expanduser(private_key_file)
+    key_classes = [paramiko.RSAKey, paramiko.ECDSAKey, getattr(paramiko, "Ed25519Key", None), paramiko.DSSKey]
+    for key_class in key_classes:
+        if key_class is None:
+            continue
+        try:
+            return key_class.from_private_key_file(private_key_file)
+        except paramiko.ssh_exception.PasswordRequiredException:
+            raise
+        except paramiko.ssh_exception.SSHException:
+            continue
+    raise paramiko.ssh_exception.SSHException("unsupported private key type: %s" % private_key_file)
+
+
 class SshTty(object):
     """
     A virtual tty class
     一个虚拟终端类，实现连接ssh和记录日志
     """
 
-    def __init__(self, user, ip, port=22, private_key_file="~/.ssh/id_rsa"):
+    def __init__(self, user, ip, port=22, private_key_file="~/.ssh/id_rsa", host_key_check=False):
+        """
+        :param host_key_check: 为True时按known_hosts校验主机密钥，拒绝未知主机
+        """
         self.ip = ip
         self.port = port
         self.ssh = None
         self.channel = None
         self.user = user
         self.private_key_file = private_key_file
+        self.host_key_check = host_key_check
+        self.write_log = None
 
     def get_connection(self):
         """
@@ -40,13 +236,16 @@ class SshTty(object):
         """
         # 发起ssh连接请求 Make a ssh connection
         ssh = paramiko.SSHClient()
-        # 不执行ssh.load_system_host_keys()， 以空白的已知主机密钥列表开始，不过这样不安全。我们在专线情况下可以这么做
-        # ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(
-            paramiko.AutoAddPolicy()
-        )  # 允许连接不在know_hosts文件中的主机
+        if self.host_key_check:
+            ssh.load_system_host_keys()
+            ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+        else:
+            # 不执行ssh.load_system_host_keys()， 以空白的已知主机密钥列表开始，不过这样不安全。我们在专线情况下可以这么做
+            ssh.set_missing_host_key_policy(
+                paramiko.AutoAddPolicy()
+            )  # 允许连接不在know_hosts文件中的主机
 
-        private_key = paramiko.RSAKey.from_private_key_file(self.private_key_file)
+        private_key = load_private_key(self.private_key_file)
         try:
             ssh.connect(
                 hostname=self.ip,
@@ -102,21 +301,52 @@ class SshTty(object):
         else:
             raise TypeError("Expected unicode or bytes, got {!r}".format(s))
 
-    def posix_shell(self):
+    def open_log(self):
         """
-        使用paramiko模块的channel，连接后端，进入交互式
+        打开会话日志
         """
-        user_home = os.environ["HOME"]
-        log_path = os.path.join(user_home, ".qssh")
-        today = time.strftime("%Y%m%d", time.localtime(int(time.time())))
-        file_name = f"{today}.his"
-        log_file = os.path.join(log_path, file_name)
+        self.write_log = get_log_writer()
 
-        if os.path.exists(log_path) is False:
-            os.makedirs(log_path)
+    def close_log(self):
+        """
+        关闭会话日志，缓冲区中的内容立即写盘
+        """
+        if self.write_log is not None:
+            self.write_log.flush()
+            self.write_log = None
+
+    def record(self, x):
+        """
+        记录日志
+        """
+        if self.write_log is not None:
+            self.write_log.write(x)
 
-        write_log = open(log_file, 'a+', encoding='utf-8')
+    def handle_output(self, data):
+        """
+        处理远端的输出，返回需要显示的内容，空字符串表示连接已断开
+        终端和网页终端共用
+        """
+        x = self.u(data)
+        if len(x) > 0:
+            self.record(x)
+        return x
 
+    def handle_input(self, data):
+        """
+        处理用户的输入，返回需要发送到远端的内容
+        终端和网页终端共用
+        """
+        x = self.u(data)
+        if x in ["\r", "\n", "\r\n"]:
+            self.record(x)
+        return x
+
+    def posix_shell(self):
+        """
+        使用paramiko模块的channel，连接后端，进入交互式
+        """
+        self.open_log()
         old_tty = termios.tcgetattr(sys.stdin)
 
         try:
@@ -133,7 +363,7 @@ class SshTty(object):
 
                 try:
                     if self.channel in r:
-                        x = self.u(self.channel.recv(1024))
+                        x = self.handle_output(self.channel.recv(1024))
                         if len(x) == 0:
                             sys.stdout.write(
                                 f"\r\n\033[32;1m {self.ip} 已断开连接...\033[0m\r\n"
@@ -143,21 +373,12 @@ class SshTty(object):
                         sys.stdout.write(x)
                         sys.stdout.flush()
 
-                        # 记录日志
-                        write_log.write(x)
-                        write_log.flush()
-
                     if sys.stdin in r:
-                        x = self.u(os.read(sys.stdin.fileno(), 4096))
+                        x = os.read(sys.stdin.fileno(), 4096)
                         if len(x) == 0:
                             break
 
-                        if x in ["\r", "\n", "\r\n"]:
-                            # 记录日志
-                            write_log.write(x)
-                            write_log.flush()
-
-                        self.channel.send(x)
+                        self.channel.send(self.handle_input(x))
 
                 except socket.timeout:
                     pass
@@ -166,10 +387,12 @@ class SshTty(object):
         finally:
             # 恢复之前的 tty
             termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_tty)
+            self.close_log()
 
-    def ssh_connect(self):
+    def open_shell(self, win_size=None):
         """
-        ssh连接服务器
+        建立连接并打开一个交互式shell通道
+        win_size为None时使用当前终端的窗口大小
         """
         # 发起ssh连接请求 Make a ssh connection
         ssh = self.get_connection()
@@ -181,14 +404,33 @@ class SshTty(object):
         transport.use_compression(True)
 
         # 获取连接的隧道并设置窗口大小 Make a channel and set windows size
-        # global channel
-        win_size = self.get_win_size()
+        if win_size is None:
+            win_size = self.get_win_size()
 
         # 打开一个通道
+        self.ssh = ssh
         self.channel = channel = transport.open_session()
         # 获取一个终端
         channel.get_pty(term="xterm", height=win_size[0], width=win_size[1])
         channel.invoke_shell()
+        return True
+
+    def close(self):
+        """
+        关闭通道和连接
+        """
+        if self.channel is not None:
+            self.channel.close()
+        if self.ssh is not None:
+            self.ssh.close()
+
+    def ssh_connect(self):
+        """
+        ssh连接服务器
+        """
+        if not self.open_shell():
+            return False
+
         try:
             signal.signal(signal.SIGWINCH, self.set_win_size)
         except:
@@ -196,10 +438,26 @@ class SshTty(object):
 
         self.posix_shell()
         # Shutdown channel socket
-        channel.close()
-        ssh.close()
+        self.close()
         return True
 
+    def run_command(self, cmd):
+        """
+        执行命令并返回结果，不打印
+        :return: (返回码, 标准输出, 错误输出)，连接失败时返回None
+        """
+        ssh = self.get_connection()
+        if ssh is None:
+            return None
+        try:
+            stdin, stdout, stderr = ssh.exec_command(cmd)
+            stdin.close()
+            stdout_content = stdout.read().decode("utf8", "ignore")
+            stderr_content = stderr.read().decode("utf8", "ignore")
+            return stdout.channel.recv_exit_status(), stdout_content, stderr_content
+        finally:
+            ssh.close()
+
     def exec_cmd(self, cmd):
         """
         连接服务器
@@ -237,6 +495,154 @@ class SshTty(object):
         ssh.close()
 
 
+class BroadcastShell(object):
+    """
+    A group of SshTty driven by one selector
+    多会话广播，一个selector处理所有主机的通道，输入的命令发送到所有主机，
+    输出按行加上主机标签合并显示；与posix_shell一样写入会话日志，输入记录一次，输出按行带主机标签记录
+    """
+
+    colors = [31, 32, 33, 34, 35, 36]
+    idle_flush = 0.2  # 空闲多久后输出没有换行的内容，如命令提示符
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.buffers = {ssh_tty.ip: "" for ssh_tty in sessions}
+        self.label_width = max(len(ssh_tty.ip) for ssh_tty in sessions)
+        self.write_log = None
+
+    def write_line(self, index, line):
+        """
+        输出一行，加上主机标签
+        """
+        ssh_tty = self.sessions[index]
+        color = self.colors[index % len(self.colors)]
+        line = line.rstrip("\r")
+        sys.stdout.write(
+            f"\033[1;{color}m{ssh_tty.ip.ljust(self.label_width)}\033[0m | {line}\n"
+        )
+        ssh_tty.record(f"{ssh_tty.ip.ljust(self.label_width)} | {line}\n")
+
+    def output(self, index, data):
+        """
+        按行输出，不完整的行先缓存
+        """
+        ip = self.sessions[index].ip
+        lines = (self.buffers[ip] + data).split("\n")
+        self.buffers[ip] = lines.pop()
+        for line in lines:
+            self.write_line(index, line)
+        sys.stdout.flush()
+
+    def flush(self, index):
+        """
+        输出缓存中不完整的行
+        """
+        ip = self.sessions[index].ip
+        if self.buffers[ip]:
+            self.write_line(index, self.buffers[ip])
+            self.buffers[ip] = ""
+            sys.stdout.flush()
+
+    def record_input(self, data):
+        """
+        广播的输入只记录一次
+        """
+        if self.write_log is not None:
+            self.write_log.write(f"[broadcast to {len(self.sessions)} hosts] {data.rstrip()}\n")
+
+    def broadcast(self, data):
+        """
+        发送到所有主机
+        """
+        for ssh_tty in self.sessions:
+            try:
+                ssh_tty.channel.send(ssh_tty.handle_input(data))
+            except (socket.error, EOFError):
+                pass
+
+    def run(self):
+        """
+        输入一行命令回车后发送到所有主机，Ctrl-C 发送到所有主机，Ctrl-D 退出
+        """
+        selector = selectors.DefaultSelector()
+        for index, ssh_tty in enumerate(self.sessions):
+            ssh_tty.channel.settimeout(0.0)
+            selector.register(ssh_tty.channel, selectors.EVENT_READ, index)
+        selector.register(sys.stdin, selectors.EVENT_READ, None)
+        for ssh_tty in self.sessions:
+            ssh_tty.open_log()
+        self.write_log = get_log_writer()
+
+        old_handler = signal.signal(signal.SIGINT, lambda sig, frame: self.broadcast("\x03"))
+        alive = len(self.sessions)
+        try:
+            while alive > 0:
+                events = selector.select(timeout=self.idle_flush)
+                if not events:
+                    for index in range(len(self.sessions)):
+                        self.flush(index)
+                    continue
+
+                for key, mask in events:
+                    index = key.data
+                    if index is None:
+                        x = self.sessions[0].u(os.read(sys.stdin.fileno(), 4096))
+                        if len(x) == 0:
+                            return
+                        self.record_input(x)
+                        self.broadcast(x.replace("\n", "\r"))
+                        continue
+
+                    ssh_tty = self.sessions[index]
+                    try:
+                        x = ssh_tty.u(ssh_tty.channel.recv(32768))
+                    except socket.timeout:
+                        continue
+                    if len(x) == 0:
+                        self.flush(index)
+                        self.write_line(index, "\033[32;1m已断开连接...\033[0m")
+                        selector.unregister(ssh_tty.channel)
+                        alive -= 1
+                        continue
+                    self.output(index, x)
+        finally:
+            signal.signal(signal.SIGINT, old_handler)
+            selector.close()
+            for ssh_tty in self.sessions:
+                ssh_tty.close_log()
+            self.write_log = None
+
+
+def broadcast_login(ip_list, log_name=None, port=22, max_connect=20):
+    """
+    同时登陆多台服务器，输入的命令广播到所有服务器
+    连接阶段使用线程池并发建立，交互阶段只有一个selector循环
+    """
+    user_home = os.environ.get("HOME") or ""
+    private_key_file = os.path.join(user_home, ".ssh/id_rsa")
+
+    def open_shell(ip):
+        ssh_tty = SshTty(user=log_name, ip=ip, port=port, private_key_file=private_key_file)
+        return ssh_tty if ssh_tty.open_shell() else None
+
+    print(f"正在登陆 {len(ip_list)} 台服务器 ...")
+    pool = ThreadPool(processes=max_connect)
+    sessions = [ssh_tty for ssh_tty in pool.map(open_shell, ip_list) if ssh_tty is not None]
+    pool.close()
+    pool.join()
+    if not sessions:
+        return False
+
+    print(f"已登陆 {len(sessions)}/{len(ip_list)} 台服务器，Ctrl-D 退出")
+    try:
+        BroadcastShell(sessions).run()
+    finally:
+        for ssh_tty in sessions:
+            ssh_tty.close()
+    return True
+
+
 def ssh_login(ip, log_name=None, port=22):
     """
     ssh登陆服务器
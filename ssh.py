@@ -6,6 +6,9 @@ import sys
 import os
 import stat
 import re
+import json
+import bisect
+import hashlib
 import time
 import paramiko
 import getpass
@@ -16,7 +19,9 @@ import socket
 import select
 import logging
 import logging.handlers
+import threading
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 from paramiko.py3compat import u
 
 try:
@@ -28,21 +33,242 @@ except ImportError:
     sys.exit()
 
 
+class LatencyStats(object):
+    """
+    Per-command latency of interactive sessions
+    交互式会话的命令延迟统计，按主机和按命令分别记录直方图(不做主机x命令的组合)，
+    所有进程的统计加锁合并到同一个node_exporter textfile文件中，超过host_ttl没有使用的主机删除
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    # (指标, 标签, 指标名, 说明)
+    metrics = (
+        ('first_output', 'host', 'qssh_command_first_output_seconds',
+         'Time from Enter to the first output of the command'),
+        ('first_output', 'cmd', 'qssh_command_first_output_by_cmd_seconds',
+         'Time from Enter to the first output of the command, by command'),
+        ('prompt', 'host', 'qssh_command_prompt_seconds', 'Time from Enter to the next shell prompt'),
+        ('prompt', 'cmd', 'qssh_command_prompt_by_cmd_seconds', 'Time from Enter to the next shell prompt, by command'),
+    )
+    # cmd标签只取这些命令，其余记为other，避免标签数量无限增长
+    tracked_commands = frozenset([
+        'ls', 'll', 'cd', 'cat', 'less', 'more', 'tail', 'head', 'grep', 'find', 'ps', 'top', 'df', 'du', 'free',
+        'netstat', 'ss', 'ping', 'curl', 'wget', 'systemctl', 'service', 'journalctl', 'docker', 'kubectl',
+        'git', 'vi', 'vim', 'python', 'python3', 'mysql', 'redis-cli', 'tar', 'cp', 'mv', 'rm', 'mkdir', 'chmod',
+        'chown', 'yum', 'apt', 'apt-get', 'rpm', 'ip', 'ifconfig', 'uptime', 'w', 'who', 'date', 'echo', 'sudo',
+    ])
+
+    def __init__(self, metrics_dir='/var/log/qssh/metrics', write_interval=10, host_ttl=7 * 86400):
+        self.metrics_dir = metrics_dir
+        self.write_interval = write_interval
+        self.host_ttl = host_ttl
+        self.last_write = 0
+        self.histograms = {}  # (指标, 标签, 标签值) -> [各桶计数..., +Inf计数, 总耗时]，只保存未写入文件的部分
+        self.lock = threading.Lock()
+
+    def command_label(self, cmd):
+        """
+        把命令映射为有限的标签值
+        """
+        name = os.path.basename(cmd)
+        return name if name in self.tracked_commands else 'other'
+
+    def observe(self, metric, host, cmd, seconds):
+        """
+        记录一次耗时
+        """
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            for key in ((metric, 'host', host), (metric, 'cmd', self.command_label(cmd))):
+                histogram = self.histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+                histogram[bucket] += 1
+                histogram[-1] += seconds
+
+    @staticmethod
+    def merge(target, source):
+        """
+        把source的计数累加到target
+        """
+        for key, histogram in source.items():
+            total = target.setdefault(key, [0] * len(histogram))
+            for index, value in enumerate(histogram):
+                total[index] += value
+
+    @staticmethod
+    def escape(value):
+        """
+        转义标签值
+        """
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self, histograms=None):
+        """
+        生成prometheus文本格式
+        """
+        lines = []
+        if histograms is None:
+            with self.lock:
+                histograms = dict(self.histograms)
+        items = sorted(histograms.items())
+        for metric, label, name, help_text in self.metrics:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s histogram' % name)
+            for (key_metric, key_label, value), histogram in items:
+                if key_metric != metric or key_label != label:
+                    continue
+                labels = '%s="%s"' % (label, self.escape(value))
+                count = 0
+                for bound, number in zip(self.buckets + ('+Inf', ), histogram[:-1]):
+                    count += number
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, count))
+                lines.append('%s_sum{%s} %s' % (name, labels, histogram[-1]))
+                lines.append('%s_count{%s} %s' % (name, labels, count))
+        return '\n'.join(lines) + '\n'
+
+    def load_state(self, state_file):
+        """
+        读取累计状态文件
+        :return: (直方图, {(指标, 标签, 标签值): 最后使用时间})
+        """
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+            # 旧格式的键包含主机x命令的组合，直接丢弃
+            histograms = dict((tuple(key), histogram) for key, histogram in state['histograms'])
+            seen = dict((tuple(key), timestamp) for key, timestamp in state['seen'])
+            return histograms, seen
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return {}, {}
+
+    def write(self, force=False):
+        """
+        加文件锁，把本进程新增的计数合并到累计状态文件，删除过期的主机，再原子写入指标文件
+        """
+        now = time.time()
+        if not force and now - self.last_write < self.write_interval:
+            return
+        self.last_write = now
+        with self.lock:
+            pending, self.histograms = self.histograms, {}
+        if not pending:
+            return
+
+        state_file = os.path.join(self.metrics_dir, 'qssh.json')
+        metrics_file = os.path.join(self.metrics_dir, 'qssh.prom')
+        lock_file = os.path.join(self.metrics_dir, '.qssh.lock')
+        try:
+            if os.path.isdir(self.metrics_dir) is False:
+                os.makedirs(self.metrics_dir)
+                os.chmod(self.metrics_dir, stat.S_IRWXO + stat.S_IRWXG + stat.S_IRWXU)  # 多个用户共用，权限为777
+            with open(lock_file, 'a') as lock:
+                try:
+                    os.chmod(lock_file, 0o666)
+                except OSError:
+                    pass
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                histograms, seen = self.load_state(state_file)
+                self.merge(histograms, pending)
+                for key in pending:
+                    seen[key] = now
+                # 命令标签有限，只有主机会无限增长
+                for key in list(histograms):
+                    if key[1] == 'host' and seen.get(key, 0) + self.host_ttl < now:
+                        del histograms[key]
+                        seen.pop(key, None)
+
+                with open(state_file + '.tmp', 'w') as f:
+                    json.dump({'histograms': [[list(key), histogram] for key, histogram in histograms.items()],
+                               'seen': [[list(key), seen.get(key, now)] for key in histograms]}, f)
+                with open(metrics_file + '.tmp', 'w') as f:
+                    f.write(self.render(histograms))
+                for path in (state_file, metrics_file):
+                    os.chmod(path + '.tmp', 0o666)
+                    os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            # 写入失败时保留计数，下次再合并
+            with self.lock:
+                self.merge(self.histograms, pending)
+
+
+latency_stats = LatencyStats()
+
+
+class JumpHost(object):
+    """
+    A bastion host shared by many SshTty
+    跳板机，只与跳板机建立一次认证连接，通过direct-tcpip通道转发到各个目标主机
+    """
+    def __init__(self, user, ip, port=22):
+        self.ip = ip
+        self.port = port
+        self.user = user
+        self.ssh = None
+        # 连接失败后本次运行不再重试，其余主机直接失败，不再逐台等待超时或输入密码
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def get_transport(self):
+        """
+        获取到跳板机的transport，断开后自动重连，连接失败后不再重试
+        """
+        with self.lock:
+            if self.failed:
+                return None
+            if self.ssh is None or not self.ssh.get_transport().is_active():
+                self.ssh = SshTty(self.user, self.ip, self.port).get_connection()
+                if self.ssh is None:
+                    self.failed = True
+                    print('Jump host %s unavailable, skip the remaining hosts' % self.ip)
+                    return None
+                self.ssh.get_transport().set_keepalive(30)
+            return self.ssh.get_transport()
+
+    def open_channel(self, ip, port=22):
+        """
+        打开一个到目标主机的direct-tcpip通道，可作为ssh.connect的sock参数
+        """
+        transport = self.get_transport()
+        if transport is None:
+            return None
+        try:
+            return transport.open_channel('direct-tcpip', (ip, port), ('127.0.0.1', 0), timeout=3)
+        except (paramiko.ssh_exception.ChannelException, paramiko.ssh_exception.SSHException, socket.error):
+            print('Jump host %s unable to reach %s:%s' % (self.ip, ip, port))
+            return None
+
+    def close(self):
+        """
+        关闭跳板机连接，所有转发的通道都会随之关闭
+        """
+        with self.lock:
+            if self.ssh is not None:
+                self.ssh.close()
+                self.ssh = None
+
+
 class SshTty(object):
     """
     A virtual tty class
     一个虚拟终端类，实现连接ssh和记录日志
     """
-    def __init__(self, user, ip, port=22):
+    # 进入/退出备用屏幕的控制序列，vim、less、top等全屏程序会使用
+    alt_screen_enter = ('\x1b[?1049h', '\x1b[?1047h', '\x1b[?47h')
+    alt_screen_exit = ('\x1b[?1049l', '\x1b[?1047l', '\x1b[?47l')
+    screen_tail_size = 256
+
+    def __init__(self, user, ip, port=22, jump_host=None):
         self.ip = ip
         self.port = port
+        self.jump_host = jump_host
         self.ssh = None
         self.channel = None
         self.user = user
         self.remote_ip = ''
         self.vim_flag = False
         self.ps1_pattern = re.compile('\[.*@.*\][\$#]')
-        self.vim_data = ''
+        self.alt_screen = False
+        self.screen_tail = ''
+        # 输出到达时看到了命令提示符，回车时据此退出vim_flag，不受命令回显长度影响
+        self.prompt_seen = False
 
     def get_logger(self):
         """
@@ -160,6 +386,20 @@ class SshTty(object):
         else:
             return ''
 
+    def track_screen(self, data):
+        """
+        跟踪是否处于全屏程序中，只保留固定长度的输出尾部，内存和耗时不随会话增长
+        """
+        text = self.screen_tail + data
+        enter = max(text.rfind(seq) for seq in self.alt_screen_enter)
+        leave = max(text.rfind(seq) for seq in self.alt_screen_exit)
+        # 备用屏幕状态与日志记录无关，远端输出不能关闭审计
+        if enter > leave:
+            self.alt_screen = True
+        elif leave > enter:
+            self.alt_screen = False
+        self.screen_tail = text[-self.screen_tail_size:]
+
     def deal_command(self, str_r):
         """
             处理命令中特殊字符
@@ -223,6 +463,17 @@ class SshTty(object):
         result_command = self.remove_control_char(result_command)
         return result_command
 
+    def get_sock(self):
+        """
+        经过跳板机时返回转发通道，直连时返回None
+        """
+        if self.jump_host is None:
+            return None
+        sock = self.jump_host.open_channel(self.ip, self.port)
+        if sock is None:
+            raise socket.error('jump host channel failed')
+        return sock
+
     def get_connection(self):
         """
         获取连接成功后的ssh
@@ -243,6 +494,7 @@ class SshTty(object):
                         pkey=private_key,
                         look_for_keys=False,  # 设置为False为禁用在~/.ssh/中搜索可用的私钥文件
                         timeout=3,
+                        sock=self.get_sock(),
                         )
             return ssh
         except paramiko.ssh_exception.BadHostKeyException:
@@ -257,11 +509,16 @@ class SshTty(object):
                             username=self.user,
                             password=password,
                             allow_agent=False,
-                            look_for_keys=False)
+                            look_for_keys=False,
+                            sock=self.get_sock())
                 return ssh
             except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
                 print('Password Authentication failed.')
                 return None
+            except socket.error:
+                # 经过跳板机时重新打开通道也可能失败
+                print('Connect to host %s timed out' % self.ip)
+                return None
         except socket.error:
             print('Connect to host %s timed out' % self.ip)
             return None
@@ -355,6 +612,9 @@ class SshTty(object):
         old_tty = termios.tcgetattr(sys.stdin)
         cmd = ''
         input_mode = False
+        command_start = None    # 回车时间，用于统计命令延迟
+        command_name = ''
+        first_output = False
         try:
             tty.setraw(sys.stdin.fileno())
             tty.setcbreak(sys.stdin.fileno())
@@ -374,8 +634,18 @@ class SshTty(object):
                         if len(x) == 0:
                             sys.stdout.write('\r\n\033[32;1m*** Session Closed ***\033[0m\r\n')
                             break
-                        if self.vim_flag:
-                            self.vim_data += x
+                        self.track_screen(x)
+                        if self.vim_flag and not self.alt_screen and self.ps1_pattern.search(self.screen_tail):
+                            self.prompt_seen = True
+                        if command_start is not None:
+                            now = time.time()
+                            if not first_output and x.strip():
+                                latency_stats.observe('first_output', self.ip, command_name, now - command_start)
+                                first_output = True
+                            if self.ps1_pattern.search(self.screen_tail):
+                                latency_stats.observe('prompt', self.ip, command_name, now - command_start)
+                                latency_stats.write()
+                                command_start = None
                         index = 0
                         while index < len(x):
                             n = os.write(sys.stdout.fileno(), bytes(x[index:], encoding='utf-8'))
@@ -396,11 +666,11 @@ class SshTty(object):
                         input_mode = True
 
                         if x in ['\r', '\n', '\r\n']:
-                            if self.vim_flag:
-                                match = self.ps1_pattern.search(self.vim_data)
-                                if match:
-                                    self.vim_flag = False
+                            # 退出全屏程序并回到命令提示符后恢复记录
+                            if self.vim_flag and not self.alt_screen and self.prompt_seen:
+                                self.vim_flag = False
 
+                            # 用户启动的编辑器(vi/fg)中的输入不记录，也不做命令限制
                             cmd = self.deal_command(cmd)[0:200]
                             # 记录用户操作日志
                             if len(cmd) > 0:
@@ -409,8 +679,13 @@ class SshTty(object):
                             # 命令限制
                             if cmd in unsupport_cmd_list:
                                 x = "\rOperation is not supported!\r\n"
+                            elif len(cmd) > 0 and not self.vim_flag:
+                                command_start = time.time()
+                                command_name = cmd.split()[0]
+                                first_output = False
                             cmd = ''
-                            self.vim_data = ''
+                            self.screen_tail = ''
+                            self.prompt_seen = False
                             input_mode = False
 
                         if len(x) == 0:
@@ -424,6 +699,7 @@ class SshTty(object):
         finally:
             # 恢复之前的 tty
             termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_tty)
+            latency_stats.write(force=True)
 
     def connect(self):
         """
@@ -453,16 +729,33 @@ class SshTty(object):
         channel.close()
         ssh.close()
 
-    def exec_cmd(self, cmd):
+    def exec_cmd(self, cmd, gather=False):
         """
         连接服务器
+        gather为True时不打印结果，返回(ip, 是否成功, 输出摘要, 输出内容)供OutputGather汇总
         """
         # 发起ssh连接请求 Make a ssh connection
         ssh = self.get_connection()
         if ssh is None:
+            if gather:
+                output = 'connect failed'
+                return self.ip, False, hashlib.md5(output.encode('utf8')).hexdigest(), output
             return None
 
         stdin, stdout, stderr = ssh.exec_command(cmd)  # 分别保存，标准输入，标准输出，错误输出
+        if gather:
+            # 边读边计算摘要
+            md5 = hashlib.md5()
+            chunks = []
+            for stream in (stdout, stderr):
+                for chunk in iter(lambda: stream.read(32768), b''):
+                    md5.update(chunk)
+                    chunks.append(chunk)
+                md5.update(b'\0')
+            success = stdout.channel.recv_exit_status() == 0
+            ssh.close()
+            return self.ip, success, md5.hexdigest(), b''.join(chunks).decode('utf8', 'ignore')
+
         stdout_content = stdout.read().decode('utf8')
         stderr_content = stderr.read().decode('utf8')
 
@@ -478,24 +771,146 @@ class SshTty(object):
         ssh.close()
 
 
-def login(ip, user=None):
+def fold_hosts(ip_list):
+    """
+    把主机列表折叠为区间，类似clush/dshbak
+    ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.7'] -> '10.0.0.[1-3,7]'
+    """
+    groups = {}
+    others = []
+    parsed = []
+    padded = {}  # 前缀 -> 以0开头的编号的位宽
+    for ip in ip_list:
+        match = re.match(r'^(.*?)(\d+)$', ip)
+        if match is None:
+            others.append(ip)
+            continue
+        prefix, digits = match.groups()
+        if digits.startswith('0') and len(digits) > 1:
+            padded.setdefault(prefix, set()).add(len(digits))
+        parsed.append((prefix, digits))
+
+    for prefix, digits in parsed:
+        # 以0开头的编号保留位宽，如web01；不以0开头但位数足够的编号(web10)与之归为一组
+        if digits.startswith('0') and len(digits) > 1:
+            width = len(digits)
+        else:
+            widths = [w for w in padded.get(prefix, ()) if w <= len(digits)]
+            width = max(widths) if widths else 0
+        groups.setdefault((prefix, width), set()).add(int(digits))
+
+    folded = []
+    for (prefix, width), numbers in sorted(groups.items()):
+        numbers = sorted(numbers)
+        ranges = []
+        start = end = numbers[0]
+        for number in numbers[1:] + [None]:
+            if number is not None and number == end + 1:
+                end = number
+                continue
+            if start == end:
+                ranges.append(str(start).zfill(width))
+            else:
+                ranges.append('%s-%s' % (str(start).zfill(width), str(end).zfill(width)))
+            if number is not None:
+                start = end = number
+        if len(numbers) == 1:
+            folded.append('%s%s' % (prefix, ranges[0]))
+        else:
+            folded.append('%s[%s]' % (prefix, ','.join(ranges)))
+    return ','.join(folded + sorted(others))
+
+
+class OutputGather(object):
+    """
+    汇总多台主机的执行结果，相同输出的主机合并显示，每种输出只保存一份
+    """
+    def __init__(self):
+        self.outputs = {}   # 摘要 -> 输出内容
+        self.hosts = {}     # (是否成功, 摘要) -> 主机列表
+        self.lock = threading.Lock()
+
+    def add(self, result):
+        """
+        作为apply_async的callback，接收exec_cmd(gather=True)的返回值
+        """
+        if result is None:
+            return
+        ip, success, digest, output = result
+        if digest is None:
+            digest = hashlib.md5(output.encode('utf8')).hexdigest()
+        with self.lock:
+            if digest not in self.outputs:
+                self.outputs[digest] = output
+            self.hosts.setdefault((success, digest), []).append(ip)
+
+    def add_error(self, ip, error):
+        """
+        handler抛出异常的主机记为失败
+        """
+        self.add((ip, False, None, 'error: %s' % error))
+
+    def summary(self):
+        """
+        打印汇总结果
+        """
+        for (success, digest), ip_list in sorted(self.hosts.items(), key=lambda item: -len(item[1])):
+            color = 32 if success else 31
+            status = 'SUCCESS' if success else 'FAILED'
+            print('\033[1;%sm%s\033[0m' % (color, '-' * 60))
+            print('\033[1;%sm%s (%s)   |    %s :\033[0m' % (color, fold_hosts(ip_list), len(ip_list), status))
+            print('\033[1;%sm%s\033[0m' % (color, '-' * 60))
+            print(self.outputs[digest])
+
+
+def handler_error(ip, output_gather=None):
+    """
+    作为apply_async的error_callback，handler抛出异常时打印失败的主机，gather模式下计入汇总
+    """
+    def callback(error):
+        if output_gather is not None:
+            output_gather.add_error(ip, error)
+        else:
+            print('\033[1;31m%s\033[0m' % '%s   |    FAILED :\n%s' % (ip, error))
+    return callback
+
+
+def login(ip, user=None, jump_host=None):
     """"""
     if user is None:
         user = getpass.getuser()  # 获取终端登录用户名
         if user != "devops":
             user = "root"
-    sshtty = SshTty(user, ip)
+    sshtty = SshTty(user, ip, jump_host=jump_host)
     sshtty.connect()
 
 
-def run_cmd(ip_list, cmd, user=None, port=22):
+def run_cmd(ip_list, cmd, user=None, port=22, jump_host=None, max_thread=2, gather=False):
+    """
+    批量执行命令
+    gather为True时相同输出的主机合并显示，并返回OutputGather
+    """
     ip_list = list(set(ip_list))
     if user is None:
         user = getpass.getuser()  # 获取终端登录用户名
         if user != "devops":
             user = "root"
 
-    max_thread = 2
+    output_gather = OutputGather() if gather else None
+    callback = output_gather.add if gather else None
+
+    if jump_host is not None:
+        # 跳板机的transport无法跨进程共享，用线程池复用同一个transport
+        pool = ThreadPool(processes=max_thread)
+        for ip in ip_list:
+            pool.apply_async(handler, (ip, user, port, cmd, jump_host, gather, ), callback=callback,
+                             error_callback=handler_error(ip, output_gather))
+        pool.close()
+        pool.join()
+        if gather:
+            output_gather.summary()
+        return output_gather
+
     current_location = 0
     while True:
         pool = multiprocessing.Pool(processes=max_thread)
@@ -504,7 +919,8 @@ def run_cmd(ip_list, cmd, user=None, port=22):
                 ip = ip_list[current_location]
             except IndexError:
                 break
-            pool.apply_async(handler, (ip, user, port, cmd, ))
+            pool.apply_async(handler, (ip, user, port, cmd, None, gather, ), callback=callback,
+                             error_callback=handler_error(ip, output_gather))
             if current_location == len(ip_list):
                 break
             current_location += 1
@@ -514,10 +930,14 @@ def run_cmd(ip_list, cmd, user=None, port=22):
         if current_location == len(ip_list):
             break
 
+    if gather:
+        output_gather.summary()
+    return output_gather
+
 
-def handler(ip, user, port, cmd):
-    ssh_tty = SshTty(user=user, ip=ip, port=port)
-    ssh_tty.exec_cmd(cmd)
+def handler(ip, user, port, cmd, jump_host=None, gather=False):
+    ssh_tty = SshTty(user=user, ip=ip, port=port, jump_host=jump_host)
+    return ssh_tty.exec_cmd(cmd, gather=gather)
 
 
 if __name__ == '__main__':
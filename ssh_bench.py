@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""
+ssh.py 批量执行的压测工具
+在本机回环地址上启动N个paramiko实现的ssh服务替身，对run_cmd/exec_cmd做压测，
+输出每秒主机数、各阶段耗时(connect, auth, exec, read)和内存峰值
+
+python3 ssh_bench.py -n 200 --threads 20 --latency 0.1 --size 4096
+"""
+import os
+import io
+import sys
+import time
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import selectors
+import contextlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import paramiko
+
+import ssh
+
+BENCH_CMD = 'bench'
+
+
+class StubServer(paramiko.ServerInterface):
+    """
+    ssh服务替身，接受任意认证，exec请求后返回固定大小的输出
+    """
+    def __init__(self):
+        self.event = threading.Event()
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_exec_request(self, channel, command):
+        self.event.set()
+        return True
+
+
+def serve_conn(conn, host_key, latency, output):
+    """
+    处理一个客户端连接
+    """
+    transport = paramiko.Transport(conn)
+    transport.add_server_key(host_key)
+    server = StubServer()
+    try:
+        transport.start_server(server=server)
+        channel = transport.accept(10)
+        if channel is None:
+            return
+        server.event.wait(10)
+        time.sleep(latency)  # 模拟命令执行耗时
+        channel.sendall(output)
+        channel.send_exit_status(0)
+        channel.close()
+        # 等待客户端主动断开
+        deadline = time.time() + 10
+        while transport.is_active() and time.time() < deadline:
+            time.sleep(0.05)
+    except (paramiko.SSHException, EOFError, socket.error):
+        pass
+    finally:
+        transport.close()
+
+
+def run_servers(hosts, port, latency, size, ready):
+    """
+    在每个回环地址上监听，用一个selector接受所有连接，每个连接一个线程
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    line = b'x' * 79 + b'\n'
+    output = (line * (size // len(line) + 1))[:size]
+
+    selector = selectors.DefaultSelector()
+    for host in hosts:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(128)
+        selector.register(sock, selectors.EVENT_READ)
+    ready.set()
+
+    while True:
+        for key, mask in selector.select():
+            conn, addr = key.fileobj.accept()
+            thread = threading.Thread(target=serve_conn, args=(conn, host_key, latency, output))
+            thread.daemon = True
+            thread.start()
+
+
+def probe(ip, port, user='bench', timeout=30):
+    """
+    按照exec_cmd的流程连接一台主机，记录各阶段耗时
+    :return: 各阶段耗时，失败时返回 {'error': 错误信息}
+    """
+    try:
+        return probe_phases(ip, port, user, timeout)
+    except Exception as error:
+        # 监听队列溢出时的连接重置、认证超时等，记为失败，不中断整个压测
+        return {'error': '%s: %s' % (type(error).__name__, error)}
+
+
+def probe_phases(ip, port, user, timeout):
+    private_key = paramiko.RSAKey.from_private_key_file(os.path.join(os.environ['HOME'], '.ssh/id_rsa'))
+    phases = {}
+
+    start = time.time()
+    sock = socket.create_connection((ip, port), timeout=3)
+    transport = paramiko.Transport(sock)
+    try:
+        transport.start_client(timeout=3)
+        phases['connect'] = time.time() - start
+
+        start = time.time()
+        transport.auth_timeout = timeout
+        transport.auth_publickey(user, private_key)
+        phases['auth'] = time.time() - start
+
+        start = time.time()
+        channel = transport.open_session(timeout=timeout)
+        channel.settimeout(timeout)
+        channel.exec_command(BENCH_CMD)
+        phases['exec'] = time.time() - start
+
+        start = time.time()
+        size = 0
+        while True:
+            data = channel.recv(32768)
+            if not data:
+                break
+            size += len(data)
+        channel.recv_exit_status()
+        phases['read'] = time.time() - start
+    finally:
+        transport.close()
+    return phases
+
+
+def percentile(values, percent):
+    """
+    计算百分位数
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def bench_phases(hosts, port, threads, timeout):
+    """
+    并发探测所有主机，统计各阶段耗时
+    """
+    pool = ThreadPool(processes=threads)
+    start = time.time()
+    try:
+        results = pool.map_async(lambda ip: probe(ip, port), hosts).get(timeout)
+    except multiprocessing.TimeoutError:
+        print('exec_cmd phases: timed out')
+        pool.terminate()
+        return
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+
+    succeeded = [result for result in results if 'error' not in result]
+    errors = {}
+    for result in results:
+        if 'error' in result:
+            errors[result['error']] = errors.get(result['error'], 0) + 1
+
+    print('exec_cmd phases: %d hosts in %.2fs, %.1f hosts/sec, %d failed' % (
+        len(hosts), elapsed, len(hosts) / elapsed, len(results) - len(succeeded)))
+    for error, count in sorted(errors.items(), key=lambda item: item[1], reverse=True):
+        print('    %6d  %s' % (count, error))
+    if not succeeded:
+        return
+    # 只统计成功的主机
+    print('    %-8s %10s %10s %10s' % ('phase', 'avg(ms)', 'p50(ms)', 'p99(ms)'))
+    for phase in ('connect', 'auth', 'exec', 'read'):
+        values = [result[phase] * 1000 for result in succeeded]
+        print('    %-8s %10.1f %10.1f %10.1f' % (phase, sum(values) / len(values),
+                                                 percentile(values, 50), percentile(values, 99)))
+
+
+def bench_run_cmd(hosts, port, threads, timeout):
+    """
+    在新的spawn进程中执行run_cmd_worker，
+    run_cmd会fork进程池，不能在已经运行过paramiko线程的进程中fork，否则子进程可能卡在加密库的锁上
+    """
+    process = multiprocessing.get_context('spawn').Process(target=run_cmd_worker, args=(hosts, port, threads))
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        print('run_cmd: timed out after %ds' % timeout)
+
+
+def run_cmd_worker(hosts, port, threads):
+    """
+    通过ssh.run_cmd压测，gather模式避免大量输出刷屏
+    """
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        output_gather = ssh.run_cmd(hosts, BENCH_CMD, user='bench', port=port, max_thread=threads, gather=True)
+    elapsed = time.time() - start
+    success = sum(len(ip_list) for (ok, digest), ip_list in output_gather.hosts.items() if ok)
+    print('run_cmd: %d/%d hosts success in %.2fs, %.1f hosts/sec' % (
+        success, len(hosts), elapsed, len(hosts) / elapsed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='ssh.py fan-out benchmark')
+    parser.add_argument('-n', '--hosts', type=int, default=50, help='number of ssh server stand-ins')
+    parser.add_argument('-p', '--port', type=int, default=2222, help='listen port of every stand-in')
+    parser.add_argument('-t', '--threads', type=int, default=10, help='concurrency of the fan-out')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before the command output is sent')
+    parser.add_argument('--size', type=int, default=1024, help='bytes of command output')
+    parser.add_argument('--timeout', type=int, default=300, help='seconds before a benchmark phase is aborted')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # 回环网段127.0.0.0/8都指向本机，每台"主机"一个地址，端口相同，与run_cmd的参数一致
+    hosts = ['127.1.%d.%d' % (i // 254, i % 254 + 1) for i in range(args.hosts)]
+
+    # 使用临时HOME，生成SshTty.get_connection需要的~/.ssh/id_rsa
+    home = tempfile.mkdtemp(prefix='ssh_bench_')
+    os.makedirs(os.path.join(home, '.ssh'))
+    paramiko.RSAKey.generate(2048).write_private_key_file(os.path.join(home, '.ssh/id_rsa'))
+    os.environ['HOME'] = home
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_servers,
+                                     args=(hosts, args.port, args.latency, args.size, ready))
+    server.daemon = True
+    server.start()
+    if not ready.wait(60):
+        print('ssh server stand-ins failed to start')
+        sys.exit(1)
+
+    print('hosts: %d, threads: %d, latency: %.3fs, output: %d bytes' % (
+        args.hosts, args.threads, args.latency, args.size))
+    try:
+        bench_phases(hosts, args.port, args.threads, args.timeout)
+        bench_run_cmd(hosts, args.port, args.threads, args.timeout)
+        # Linux下ru_maxrss单位为KB
+        print('peak memory: self %.1f MB, children %.1f MB' % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0))
+    finally:
+        server.terminate()
+        # 临时HOME中有生成的私钥
+        shutil.rmtree(home, True)
+
+
+if __name__ == '__main__':
+    main()
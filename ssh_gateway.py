@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""
+网页终端网关，一个进程的asyncio事件循环上同时承载上百个pyssh会话
+浏览器通过websocket连接 ws://127.0.0.1:8022/ssh?token=xxx&host=10.0.0.1&user=root&port=22&rows=24&cols=80
+客户端发送文本消息 {"type": "input", "data": "ls\r"} 或 {"type": "resize", "rows": 40, "cols": 120}
+服务端以二进制消息返回终端输出
+
+python3 ssh_gateway.py --listen 127.0.0.1 --port 8022 --allow-origin http://127.0.0.1:8000 --allow-host 10.0.0.0/8
+
+网关使用运维人员的私钥登录，为防止任意网页发起跨站websocket连接：
+每次启动生成一个令牌(或用--token指定)，连接时需带上 &token=...；
+请求头Origin必须在--allow-origin中；host和user只能是--allow-host、--allow-user允许的值
+"""
+import os
+import hmac
+import json
+import socket
+import asyncio
+import fnmatch
+import secrets
+import argparse
+import ipaddress
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import websockets
+
+from pyssh import SshTty
+
+
+class GatewaySession(object):
+    """
+    一个网页终端会话
+    paramiko的网络读写在它自己的transport线程中完成，事件循环只从通道缓冲区取数据；
+    连接、发送等可能阻塞的操作放到线程池中执行
+    """
+
+    def __init__(self, websocket, ssh_tty, executor, queue_size=64):
+        self.loop = asyncio.get_event_loop()
+        self.websocket = websocket
+        self.ssh_tty = ssh_tty
+        self.executor = executor
+        self.queue = asyncio.Queue()
+        self.queue_size = queue_size
+        self.reading = False
+
+    def start_reading(self):
+        """
+        开始监听通道
+        """
+        if not self.reading:
+            self.loop.add_reader(self.ssh_tty.channel.fileno(), self.on_channel_readable)
+            self.reading = True
+
+    def stop_reading(self):
+        """
+        暂停监听通道
+        """
+        if self.reading:
+            self.loop.remove_reader(self.ssh_tty.channel.fileno())
+            self.reading = False
+
+    def on_channel_readable(self):
+        """
+        通道有数据时由事件循环回调，数据已在paramiko缓冲区中，recv不会阻塞
+        """
+        data = self.ssh_tty.channel.recv(32768)
+        if len(data) == 0:
+            self.stop_reading()
+            self.queue.put_nowait(None)
+            return
+        x = self.ssh_tty.handle_output(data)
+        self.queue.put_nowait(x.encode("utf-8"))
+        # 客户端太慢时暂停读取通道，paramiko不再调整窗口，远端随之停止发送
+        if self.queue.qsize() >= self.queue_size:
+            self.stop_reading()
+
+    async def send_output(self):
+        """
+        把终端输出发送给浏览器
+        """
+        while True:
+            data = await self.queue.get()
+            if data is None:
+                await self.websocket.close(reason="session closed")
+                return
+            await self.websocket.send(data)
+            if self.queue.qsize() <= self.queue_size // 2:
+                self.start_reading()
+
+    async def receive_input(self):
+        """
+        把浏览器的输入发送到远端
+        """
+        channel = self.ssh_tty.channel
+        async for message in self.websocket:
+            if isinstance(message, bytes):
+                message = {"type": "input", "data": message}
+            else:
+                try:
+                    message = json.loads(message)
+                except ValueError:
+                    continue
+
+            if message.get("type") == "input":
+                x = self.ssh_tty.handle_input(message.get("data", ""))
+                await self.loop.run_in_executor(self.executor, channel.sendall, x)
+            elif message.get("type") == "resize":
+                win_size = parse_win_size(message.get("rows"), message.get("cols"))
+                if win_size is None:
+                    continue
+                await self.loop.run_in_executor(
+                    self.executor,
+                    lambda: channel.resize_pty(height=win_size[0], width=win_size[1]),
+                )
+
+    async def run(self):
+        self.start_reading()
+        sender = asyncio.ensure_future(self.send_output())
+        receiver = asyncio.ensure_future(self.receive_input())
+        try:
+            await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.stop_reading()
+            sender.cancel()
+            receiver.cancel()
+
+
+def parse_win_size(rows, cols):
+    """
+    校验终端大小，不合法时返回None
+    """
+    try:
+        rows, cols = int(rows), int(cols)
+    except (TypeError, ValueError):
+        return None
+    if not (0 < rows <= 1000 and 0 < cols <= 1000):
+        return None
+    return rows, cols
+
+
+def request_headers(websocket):
+    """
+    兼容新旧版本websockets的请求头
+    """
+    headers = getattr(websocket, "request_headers", None)
+    if headers is None:
+        headers = websocket.request.headers
+    return headers
+
+
+class Gateway(object):
+    """
+    网页终端网关
+    """
+
+    def __init__(self, private_key_file=None, workers=32, max_sessions=500, queue_size=64, token=None,
+                 allowed_origins=(), allowed_hosts=(), allowed_users=("root", )):
+        """
+        :param token: 连接令牌，为空时每次启动随机生成
+        :param allowed_origins: 允许的Origin，如 http://127.0.0.1:8000
+        :param allowed_hosts: 允许连接的主机，网段(10.0.0.0/8)或通配符(web*.example.com)
+        :param allowed_users: 允许登录的用户
+        """
+        user_home = os.environ.get("HOME") or ""
+        self.private_key_file = private_key_file or os.path.join(user_home, ".ssh/id_rsa")
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_sessions = max_sessions
+        self.queue_size = queue_size
+        self.sessions = 0
+        self.token = token or secrets.token_urlsafe(32)
+        self.allowed_origins = set(allowed_origins)
+        self.allowed_users = set(allowed_users)
+        self.allowed_networks = []
+        self.allowed_patterns = []
+        for host in allowed_hosts:
+            try:
+                self.allowed_networks.append(ipaddress.ip_network(host, strict=False))
+            except ValueError:
+                self.allowed_patterns.append(host)
+
+    def host_allowed(self, host):
+        """
+        主机是否在允许的网段或通配符中
+        """
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return any(fnmatch.fnmatch(host, pattern) for pattern in self.allowed_patterns)
+        return any(address in network for network in self.allowed_networks)
+
+    def check(self, websocket, query):
+        """
+        校验令牌、Origin和连接参数
+        :return: 拒绝原因，通过时返回None
+        """
+        if not hmac.compare_digest(query.get("token", ""), self.token):
+            return "invalid token"
+        origin = request_headers(websocket).get("Origin")
+        # 浏览器总会带上Origin，非浏览器客户端可以不带
+        if origin is not None and origin not in self.allowed_origins:
+            return "origin not allowed"
+        if "host" not in query:
+            return "missing host"
+        if not self.host_allowed(query["host"]):
+            return "host not allowed"
+        if query.get("user", "root") not in self.allowed_users:
+            return "user not allowed"
+        try:
+            port = int(query.get("port", 22))
+        except ValueError:
+            return "invalid port"
+        if not 0 < port < 65536:
+            return "invalid port"
+        if parse_win_size(query.get("rows", 24), query.get("cols", 80)) is None:
+            return "invalid window size"
+        return None
+
+    async def handler(self, websocket, path=None):
+        # 兼容新旧版本websockets的handler参数
+        if path is None:
+            path = getattr(websocket, "path", None) or websocket.request.path
+        query = {key: value[0] for key, value in parse_qs(urlparse(path).query).items()}
+        reason = self.check(websocket, query)
+        if reason is not None:
+            # 1008: policy violation
+            await websocket.close(code=1008, reason=reason)
+            return
+        if self.sessions >= self.max_sessions:
+            await websocket.close(reason="too many sessions")
+            return
+
+        loop = asyncio.get_event_loop()
+        ssh_tty = SshTty(
+            user=query.get("user", "root"),
+            ip=query["host"],
+            port=int(query.get("port", 22)),
+            private_key_file=self.private_key_file,
+        )
+        win_size = parse_win_size(query.get("rows", 24), query.get("cols", 80))
+
+        self.sessions += 1
+        try:
+            ok = await loop.run_in_executor(self.executor, ssh_tty.open_shell, win_size)
+            if not ok:
+                await websocket.close(reason=f"unable connect to {ssh_tty.ip}")
+                return
+            ssh_tty.open_log()
+            await GatewaySession(websocket, ssh_tty, self.executor, self.queue_size).run()
+        except (socket.error, EOFError, websockets.ConnectionClosed):
+            pass
+        finally:
+            self.sessions -= 1
+            ssh_tty.close_log()
+            await loop.run_in_executor(self.executor, ssh_tty.close)
+
+    def serve_forever(self, host, port):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(websockets.serve(self.handler, host, port))
+        print(f"web terminal gateway serving at ws://{host}:{port}/ssh?token={self.token}")
+        loop.run_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="web terminal gateway for pyssh")
+    parser.add_argument("--listen", default="127.0.0.1", help="listen address")
+    parser.add_argument("-p", "--port", type=int, default=8022, help="listen port")
+    parser.add_argument("--workers", type=int, default=32, help="threads for connect and send")
+    parser.add_argument("--max-sessions", type=int, default=500, help="max concurrent sessions")
+    parser.add_argument("--token", default=os.environ.get("SSH_GATEWAY_TOKEN"),
+                        help="connection token, random for every launch by default")
+    parser.add_argument("--allow-origin", action="append", default=[],
+                        help="allowed Origin of the web page, can be repeated")
+    parser.add_argument("--allow-host", action="append", required=True,
+                        help="allowed target hosts, network (10.0.0.0/8) or wildcard (web*), can be repeated")
+    parser.add_argument("--allow-user", action="append", default=None,
+                        help="allowed login users, can be repeated, default root")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    gateway = Gateway(workers=args.workers, max_sessions=args.max_sessions, token=args.token,
+                      allowed_origins=args.allow_origin, allowed_hosts=args.allow_host,
+                      allowed_users=args.allow_user or ["root"])
+    try:
+        gateway.serve_forever(args.listen, args.port)
+    except KeyboardInterrupt:
+        print(" Interrupted")
+
+
+if __name__ == "__main__":
+    main()